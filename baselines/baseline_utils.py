@@ -5,20 +5,25 @@ from dataset import HINT, HINT_collate
 
 INP_VOCAB = SYMBOLS + [START, END, NULL]
 RES_VOCAB = DIGITS + [START, END, NULL]
+RES_TABLE = SymbolTable(RES_VOCAB)
 
 RES_MAX_LEN = 10
 
 reverse = True
 def res2seq(res, pad=True):
-    seq = [list(str(r)) for r in res]
+    digits = [RES_TABLE.encode(str(r)) for r in res]
     if reverse:
-        seq = [s[::-1] for s in seq]
-    seq = [[START] + s + [END] for s in seq]
-    if pad:
-        max_len = max([len(s) for s in seq])
-        seq = [s + [NULL]*(max_len - len(s)) for s in seq]
-    seq = [list(map(RES_VOCAB.index, s)) for s in seq]
-    return seq
+        digits = [d[::-1] for d in digits]
+    start, end, null = RES_TABLE.index(START), RES_TABLE.index(END), RES_TABLE.index(NULL)
+    if not pad:
+        return [[start] + d.tolist() + [end] for d in digits]
+    max_len = max([len(d) for d in digits]) + 2
+    seq = np.full((len(digits), max_len), null, dtype=np.int64)
+    seq[:, 0] = start
+    for i, d in enumerate(digits):
+        seq[i, 1:len(d)+1] = d
+        seq[i, len(d)+1] = end
+    return seq.tolist()
 
 def seq2res(seq):
     seq = [RES_VOCAB[x] for x in seq]
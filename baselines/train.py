@@ -9,7 +9,7 @@ pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
-from dataset import HINT, HINT_collate
+from dataset import HINT, HINT_collate, unpad
 from model import make_model
 
 import torch
@@ -75,11 +75,11 @@ def evaluate(model, dataloader):
     with torch.no_grad():
         for sample in tqdm(dataloader):
             img = sample['img_seq']
-            src = torch.tensor([x for s in sample['sentence'] for x in s])
+            src = torch.cat([s[:l] for s, l in zip(sample['sentence'], sample['len'])])
             res = sample['res']
             trg = torch.tensor(res2seq(res.numpy()))
             expr = sample['expr']
-            dep = sample['head']
+            dep = unpad(sample['head'], sample['len'])
             src_len = sample['len']
             tgt_len = [len(str(x)) for x in res.numpy()]
 
@@ -208,7 +208,7 @@ def train(model, args, st_epoch=0):
         train_loss = []
         for sample in tqdm(train_dataloader):
             img = sample['img_seq']
-            src = torch.tensor([x for s in sample['sentence'] for x in s])
+            src = torch.cat([s[:l] for s, l in zip(sample['sentence'], sample['len'])])
             res = sample['res']
             trg = torch.tensor(res2seq(res.numpy()))
             src_len = sample['len']
@@ -0,0 +1,104 @@
+"""
+Compare the perception abduction (AST.abduce_perception) with the single-position loop it replaced.
+    python bench_abduction.py --n-samples 2000 --n-errors 1 --budgets 100 1000
+The samples are random expressions under the ground-truth semantics and parse, where n-errors symbols are
+misrecognized: the perception gives the wrong symbol the highest probability, and the true one a random lower one.
+For each abduction, the fraction of samples fixed (a sentence giving the right result is found) and the
+number of fixes per second are reported.
+"""
+import argparse
+import random
+import time
+from copy import deepcopy
+
+import numpy as np
+
+from jointer import AST, Parse, abduce_stats
+from semantics import SemanticsGT
+from utils import SYMBOLS
+
+DIGITS = [SYMBOLS.index(str(i)) for i in range(10)]
+OPERATORS = [SYMBOLS.index(c) for c in '+-*/']
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark the perception abduction')
+    parser.add_argument('--n-samples', type=int, default=2000)
+    parser.add_argument('--max-ops', type=int, default=5, help='max number of operators of an expression')
+    parser.add_argument('--n-errors', type=int, default=1, help='number of misrecognized symbols of an expression')
+    parser.add_argument('--budgets', type=int, nargs='+', default=[100], help='budgets of AST.abduce_perception')
+    parser.add_argument('--repeats', type=int, default=3, help='the fastest of the repeated runs is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+def random_expression(n_ops):
+    # (sentence, head) of a random expression with n_ops binary operators
+    if n_ops == 0:
+        return [random.choice(DIGITS)], [-1]
+    n_left = random.randint(0, n_ops - 1)
+    left, left_head = random_expression(n_left)
+    right, right_head = random_expression(n_ops - 1 - n_left)
+    k = len(left)
+    head = [k if h == -1 else h for h in left_head] + [-1] + [k if h == -1 else h + k + 1 for h in right_head]
+    return left + [random.choice(OPERATORS)] + right, head
+
+def make_sample(semantics, max_ops, n_errors):
+    while True:
+        sentence, head = random_expression(random.randint(0, max_ops))
+        y = AST(Parse(sentence, head), semantics).res()
+        if y is None or n_errors > len(sentence):
+            continue
+        probs = np.random.dirichlet(np.full(len(SYMBOLS), 0.1), size=len(sentence)) * 0.05
+        probs[range(len(sentence)), sentence] += 0.95
+        perceived = list(sentence)
+        for k in random.sample(range(len(sentence)), n_errors):
+            wrong = random.choice([s for s in range(len(SYMBOLS)) if s != sentence[k]])
+            probs[k] = np.random.dirichlet(np.full(len(SYMBOLS), 0.1)) * 0.05
+            probs[k, wrong] += 0.6
+            probs[k, sentence[k]] += random.uniform(0., 0.35) # not always the second most probable symbol
+            perceived[k] = wrong
+        probs /= probs.sum(1, keepdims=True)
+        et = AST(Parse(perceived, head), semantics, probs)
+        if et.res() != y:
+            return et, y
+
+def baseline_abduce(et, y):
+    # the single-position loop of the baseline: each position by increasing probability, each symbol by decreasing
+    sent_pos_list = np.argsort([et.sent_probs[i, s] for i, s in enumerate(et.pt.sentence)])
+    for sent_pos in sent_pos_list:
+        s_prob = et.sent_probs[sent_pos]
+        for sym in np.argsort(s_prob)[::-1]:
+            sentence = deepcopy(et.pt.sentence)
+            sentence[sent_pos] = sym
+            new_et = AST(Parse(sentence, et.pt.head), et.semantics)
+            if new_et.res() is not None and new_et.res() == y:
+                return new_et
+    return None
+
+def report(name, abduce, samples, repeats=3):
+    elapsed = float('inf')
+    for _ in range(repeats):
+        st = time.time()
+        n_found = 0
+        for et, y in samples:
+            new_et = abduce(et, y)
+            if new_et is not None:
+                assert new_et.res() == y
+                n_found += 1
+        elapsed = min(elapsed, time.time() - st)
+    print('%-12s %10s %10.2f %12.1f' % (name, '%d/%d' % (n_found, len(samples)), 100 * n_found / len(samples),
+                                        n_found / elapsed))
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    semantics = SemanticsGT()()
+    samples = [make_sample(semantics, args.max_ops, args.n_errors) for _ in range(args.n_samples)]
+
+    print('%d samples with %d misrecognized symbols' % (len(samples), args.n_errors))
+    print('%-12s %10s %10s %12s' % ('', 'fixed', 'fixed %', 'fixes/s'))
+    report('baseline', baseline_abduce, samples, args.repeats)
+    for budget in args.budgets:
+        report('budget-%d' % budget, lambda et, y, b=budget: et.abduce_perception(y, budget=b), samples, args.repeats)
+    print("Abduction: ", sorted(abduce_stats.items()))
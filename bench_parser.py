@@ -0,0 +1,86 @@
+"""
+Compare the decoding of the parser: greedy, beam search and exact search (Parser.parse_dp), on ground-truth sentences.
+    python bench_parser.py --resume outputs/model_100.p --split test
+Without --resume, the parser is first learned on the ground-truth parses of the training set for --n-iters.
+For each decoding, the speed and the accuracy of the heads and of the whole trees are reported, the accuracy of the
+trees also by length.
+"""
+import argparse
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+import checkpoint
+from dataset import HINT
+from utils import SYMBOL_TABLE
+from syntax import Parser
+
+Parse = namedtuple('Parse', ['sentence', 'head'])
+LENGTH_BUCKETS = [1, 3, 7, 11, 15, 23, 31, float('inf')]
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark the decoding of the parser')
+    parser.add_argument('--resume', type=str, default=None, help='checkpoint saved by Jointer.save')
+    parser.add_argument('--split', type=str, default='test', help='split to decode')
+    parser.add_argument('--n-samples', type=int, default=None, help='decode only the first n samples of the split')
+    parser.add_argument('--n-iters', type=int, default=100, help='n_iters of Parser.learn without --resume')
+    parser.add_argument('--beam-sizes', type=int, nargs='+', default=[4, 16], help='beam sizes of beam search')
+    parser.add_argument('--max-exact-len', type=int, default=15, help='longest sentence decoded by exact search')
+    parser.add_argument('--max-states', type=int, default=2000, help='max expansions of the exact search per sentence')
+    parser.add_argument('--threads', type=int, default=None, help='number of threads used by torch')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+def load_parses(split, n_samples=None):
+    dataset = HINT(split).dataset[:n_samples]
+    return [Parse(SYMBOL_TABLE.encode(''.join(x['expr'])).tolist(), list(x['head'])) for x in dataset]
+
+def report(name, parses, gold, elapsed):
+    lengths = np.array([len(x.sentence) for x in gold])
+    correct = [np.array(pt.head) == np.array(x.head) for pt, x in zip(parses, gold)]
+    head_acc = np.concatenate(correct).mean()
+    tree_acc = np.array([c.all() for c in correct])
+    print('%-10s %10.1f %10.2f %10.2f' % (name, len(gold) / elapsed, 100 * head_acc, 100 * tree_acc.mean()), end='')
+    for lo, hi in zip(LENGTH_BUCKETS[:-1], LENGTH_BUCKETS[1:]):
+        mask = (lengths > lo) & (lengths <= hi) if lo > 1 else lengths <= hi
+        print(' %8s' % ('%.2f' % (100 * tree_acc[mask].mean()) if mask.any() else '-'), end='')
+    print()
+
+def run(decode, sentences):
+    st = time.time()
+    with torch.no_grad():
+        parses = decode(sentences)
+    return parses, time.time() - st
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    parser = Parser()
+    if args.resume is not None:
+        parser.load(checkpoint.load(args.resume, map_location='cpu')['syntax'])
+    else:
+        print('Learn the parser on the ground-truth parses for %d iterations, ' % args.n_iters, end='', flush=True)
+        parser.learn(load_parses('train'), n_iters=args.n_iters)
+        print()
+    parser.eval()
+
+    gold = load_parses(args.split, args.n_samples)
+    sentences = [x.sentence for x in gold]
+    decodes = [('greedy', parser.parse)]
+    decodes += [('beam-%d' % k, lambda s, k=k: parser.parse_beam(s, beam_size=k)) for k in args.beam_sizes]
+    decodes += [('exact', lambda s: parser.parse_dp(s, max_exact_len=args.max_exact_len, max_states=args.max_states))]
+
+    print('%d sentences of %s, tree accuracy by length in %s' % (len(gold), args.split, LENGTH_BUCKETS[1:]))
+    print('%-10s %10s %10s %10s %s' % ('', 'sent/s', 'head acc', 'tree acc', 'by length'))
+    for name, decode in decodes:
+        parses, elapsed = run(decode, sentences)
+        report(name, parses, gold, elapsed)
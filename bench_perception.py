@@ -0,0 +1,92 @@
+"""
+Compare fp32 and bfloat16 autocast for the perception on CPU, on the workload of Perception.learn.
+    python bench_perception.py --n-train 20000 --n-test 5000 --n-iters 100
+Both runs start from the same initial weights and learn on the same symbols. For each run, the training
+throughput of Perception.learn, and the inference throughput and accuracy on held-out symbols are reported.
+"""
+import os
+os.environ['CUDA_VISIBLE_DEVICES'] = '' # the benchmark is CPU-only
+
+import argparse
+import random
+import time
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from dataset import HINT
+from perception import Perception
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark bfloat16 autocast for the perception')
+    parser.add_argument('--n-train', type=int, default=20000, help='number of symbols to learn from')
+    parser.add_argument('--n-test', type=int, default=5000, help='number of held-out symbols')
+    parser.add_argument('--n-iters', type=int, default=100, help='n_iters of Perception.learn')
+    parser.add_argument('--pretrain', type=str, default=None, help='initialize the perception from a pretrained model')
+    parser.add_argument('--threads', type=int, default=None, help='number of threads used by torch')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def evaluate(perception, symbols):
+    perception.eval()
+    n_correct = 0
+    n_images = 0
+    dataloader = perception.image_loader(symbols)
+    st = time.time()
+    with torch.no_grad():
+        for img, label in dataloader:
+            preds, _ = perception(img)
+            n_correct += (preds == label).sum().item()
+            n_images += len(label)
+    return n_correct / n_images, n_images / (time.time() - st)
+
+def run(bf16, init_state, train_symbols, test_symbols, n_iters, seed):
+    perception = Perception(bf16=bf16)
+    perception.load(deepcopy(init_state))
+    if bf16 and not perception.bf16:
+        return None
+
+    seed_all(seed)
+    # the same number of samples as drawn by Perception.learn
+    n_epochs = int(np.ceil(512 * n_iters / len(train_symbols)))
+    st = time.time()
+    perception.learn(list(train_symbols), n_iters)
+    learn_speed = n_epochs * len(train_symbols) / (time.time() - st)
+    print()
+
+    acc, infer_speed = evaluate(perception, test_symbols)
+    return learn_speed, infer_speed, acc
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    seed_all(args.seed)
+    symbols = HINT('train').all_symbols()
+    random.shuffle(symbols)
+    test_symbols = symbols[:args.n_test]
+    train_symbols = symbols[args.n_test:args.n_test + args.n_train]
+
+    init_state = Perception().save()
+    if args.pretrain is not None:
+        init_state['model'] = torch.load(args.pretrain, map_location='cpu')
+
+    results = {}
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        print('Running %s...'%name)
+        results[name] = run(bf16, init_state, train_symbols, test_symbols, args.n_iters, args.seed)
+
+    print('%-6s %16s %16s %10s'%('', 'learn (img/s)', 'infer (img/s)', 'test acc'))
+    for name, res in results.items():
+        if res is None:
+            print('%-6s not supported on this CPU'%name)
+            continue
+        print('%-6s %16.1f %16.1f %10.2f'%(name, res[0], res[1], 100 * res[2]))
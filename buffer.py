@@ -0,0 +1,125 @@
+import random
+import numpy as np
+
+class GrowableArray(object):
+    """ A 1-d numpy array with amortized O(1) appends. """
+    def __init__(self, dtype, capacity=1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        n = self.size + len(values)
+        if n > len(self.data):
+            data = np.zeros(max(n, 2 * len(self.data)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:n] = values
+        self.size = n
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+class SampleBuffer(object):
+    """ Abduced samples stored as a struct of arrays instead of AST objects.
+        The symbols of sample i are at offsets[i]:offsets[i+1] of the flat arrays:
+        sentences (int8), heads (int16), node results (int64, with a mask for None) and image ids (int32).
+        Image paths are interned in a table shared by all samples.
+    """
+    def __init__(self):
+        self.offsets = GrowableArray(np.int64)
+        self.offsets.extend([0])
+        self.sentences = GrowableArray(np.int8)
+        self.heads = GrowableArray(np.int16)
+        self.results = GrowableArray(np.int64)
+        self.results_mask = GrowableArray(bool)
+        self.img_ids = GrowableArray(np.int32)
+        self.img_paths = []
+        self.img2id = {}
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def append(self, sentence, head, results, img_paths):
+        self.offsets.extend([self.offsets.values[-1] + len(sentence)])
+        self.sentences.extend(sentence)
+        self.heads.extend(head)
+        self.results.extend([0 if r is None else r for r in results])
+        self.results_mask.extend([r is not None for r in results])
+        img_ids = []
+        for p in img_paths:
+            if p not in self.img2id:
+                self.img2id[p] = len(self.img_paths)
+                self.img_paths.append(p)
+            img_ids.append(self.img2id[p])
+        self.img_ids.extend(img_ids)
+
+    def append_ast(self, ast, img_paths):
+        self.append(ast.pt.sentence, ast.pt.head, ast.res_all(), img_paths)
+
+    def extend(self, other):
+        for i in range(len(other)):
+            self.append(*other[i])
+
+    def __getitem__(self, i):
+        st, ed = self.offsets.values[i], self.offsets.values[i+1]
+        results = [int(r) if m else None for r, m in zip(self.results.values[st:ed], self.results_mask.values[st:ed])]
+        img_paths = [self.img_paths[k] for k in self.img_ids.values[st:ed]]
+        return self.sentences.values[st:ed].tolist(), self.heads.values[st:ed].tolist(), results, img_paths
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sample(self, k):
+        subset = SampleBuffer()
+        for i in random.sample(range(len(self)), k=k):
+            subset.append(*self[i])
+        return subset
+
+    def lengths(self):
+        return np.diff(self.offsets.values)
+
+    def symbol_counts(self):
+        return np.bincount(self.sentences.values)
+
+    def parses(self):
+        # (sentence, head) of each sample
+        offsets = self.offsets.values
+        sentences = self.sentences.values.tolist()
+        heads = self.heads.values.tolist()
+        return [(sentences[st:ed], heads[st:ed]) for st, ed in zip(offsets[:-1], offsets[1:])]
+
+    def symbol_images(self):
+        # (image path, symbol) of all the symbols in the buffer
+        return [(self.img_paths[k], s) for k, s in zip(self.img_ids.values.tolist(), self.sentences.values.tolist())]
+
+    def encode(self):
+        # compact encoding to be sent to other processes
+        return {
+            'offsets': self.offsets.values,
+            'sentences': self.sentences.values,
+            'heads': self.heads.values,
+            'results': self.results.values,
+            'results_mask': self.results_mask.values,
+            'img_paths': '\n'.join([self.img_paths[k] for k in self.img_ids.values]),
+        }
+
+    @staticmethod
+    def decode(encoded):
+        buffer = SampleBuffer()
+        img_paths = encoded['img_paths'].split('\n') if len(encoded['sentences']) > 0 else []
+        buffer.offsets.extend(encoded['offsets'][1:])
+        buffer.sentences.extend(encoded['sentences'])
+        buffer.heads.extend(encoded['heads'])
+        buffer.results.extend(encoded['results'])
+        buffer.results_mask.extend(encoded['results_mask'])
+        img_ids = []
+        for p in img_paths:
+            if p not in buffer.img2id:
+                buffer.img2id[p] = len(buffer.img_paths)
+                buffer.img_paths.append(p)
+            img_ids.append(buffer.img2id[p])
+        buffer.img_ids.extend(img_ids)
+        return buffer
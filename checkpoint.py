@@ -0,0 +1,91 @@
+import copy
+import json
+import os
+import threading
+import uuid
+
+import torch
+
+MODULES = ['perception', 'syntax', 'semantics']
+
+def snapshot(obj):
+    # copy of a saved state, so that it can be written while the training goes on
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    if isinstance(obj, str):
+        with open(tmp_path, 'w') as f:
+            f.write(obj)
+    else:
+        torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def is_manifest(path):
+    with open(path, 'rb') as f:
+        return f.read(1) == b'{'
+
+def load(load_path, map_location=None):
+    """ Load a checkpoint, either a manifest written by Checkpointer or a single file written by torch.save. """
+    if not is_manifest(load_path):
+        return torch.load(load_path, map_location=map_location)
+    manifest = json.load(open(load_path))
+    shard_dir = os.path.dirname(load_path)
+    model = {'epoch': manifest['epoch']}
+    for name, shard in manifest['shards'].items():
+        model[name] = torch.load(os.path.join(shard_dir, shard), map_location=map_location)
+    return model
+
+class Checkpointer(object):
+    """ Save the modules of a Jointer in a background thread.
+        Each module is written to its own shard, and a shard is only written again if the version of the module
+        has changed since the last save. The checkpoint itself is a manifest listing the shards, which is
+        replaced atomically after all its shards are written.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.shards = {} # module name -> (version, shard directory, shard file)
+        self.thread = None
+        self.error = None
+
+    def save(self, save_path, epoch=None):
+        self.wait()
+        shard_dir = os.path.dirname(save_path)
+        manifest = {'epoch': epoch, 'shards': {}}
+        states = {}
+        for name in MODULES:
+            version = getattr(self.model, name).version
+            saved = self.shards.get(name)
+            if saved is None or saved[0] != version or saved[1] != shard_dir:
+                shard = 'shards/%s_%s.p'%(name, uuid.uuid4().hex[:8])
+                states[shard] = snapshot(getattr(self.model, name).save())
+                self.shards[name] = (version, shard_dir, shard)
+            manifest['shards'][name] = self.shards[name][2]
+
+        self.thread = threading.Thread(target=self._write, args=(save_path, manifest, states))
+        self.thread.start()
+
+    def _write(self, save_path, manifest, states):
+        try:
+            shard_dir = os.path.dirname(save_path)
+            os.makedirs(os.path.join(shard_dir, 'shards'), exist_ok=True)
+            for shard, state in states.items():
+                atomic_save(state, os.path.join(shard_dir, shard))
+            atomic_save(json.dumps(manifest), save_path)
+        except Exception as e:
+            self.error = e
+            self.shards = {} # write all the shards again in the next save
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
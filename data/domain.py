@@ -1,3 +1,5 @@
+import numpy as np
+
 DIGITS= [str(i) for i in range(0, 10)]
 OPERATORS = list('+-*/')
 PARENTHESES = list('()')
@@ -5,9 +7,46 @@ START = '<START>'
 END = '<END>'
 NULL = '<NULL>'
 SYMBOLS = DIGITS + OPERATORS + PARENTHESES
-# SYM2ID = {v:i for i, v in enumerate(SYMBOLS)}
-# ID2SYM = {i:v for i, v in enumerate(SYMBOLS)}
-SYM2ID = lambda x: SYMBOLS.index(x)
+
+class SymbolTable(object):
+    """ Dense encoding of a vocabulary: a dict for single lookups, and a 256-entry array indexed by the byte
+        of a single-character symbol, so that a whole expression is encoded with one numpy indexing.
+        The tables are rebuilt whenever the vocabulary has grown, e.g. SYMBOLS.append for few-shot concepts.
+    """
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.size = -1
+
+    def sync(self):
+        if self.size != len(self.vocab):
+            self.ids = {v:i for i, v in enumerate(self.vocab)}
+            self.lut = np.full(256, -1, dtype=np.int64)
+            for v, i in self.ids.items():
+                if len(v) == 1 and ord(v) < 256:
+                    self.lut[ord(v)] = i
+            self.array = np.array(self.vocab, dtype=object)
+            self.size = len(self.vocab)
+
+    def index(self, x):
+        self.sync()
+        if x not in self.ids:
+            raise ValueError('%r is not a symbol'%(x,))
+        return self.ids[x]
+
+    def encode(self, expr):
+        # expr: a string of single-character symbols
+        self.sync()
+        ids = self.lut[np.frombuffer(expr.encode('latin-1'), dtype=np.uint8)]
+        if (ids < 0).any():
+            raise ValueError('%r contains unknown symbols'%(expr,))
+        return ids
+
+    def decode(self, ids):
+        self.sync()
+        return ''.join(self.array[np.asarray(ids, dtype=np.int64)])
+
+SYMBOL_TABLE = SymbolTable(SYMBOLS)
+SYM2ID = SYMBOL_TABLE.index
 ID2SYM = lambda x: SYMBOLS[x]
 
 import math
@@ -1,13 +1,35 @@
-from utils import SYM2ID, ROOT_DIR, IMG_DIR, NULL, IMG_TRANSFORM, pad_image
+from utils import SYMBOL_TABLE, ROOT_DIR, IMG_DIR, NULL, load_image
 from copy import deepcopy
 import random
 import json
 import numpy as np
-from PIL import Image, ImageOps
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, get_worker_info
 from torch.utils.data.dataloader import default_collate
-from torchvision import transforms
+
+def pack_parses(heads):
+    """ Pack the ground-truth parses of all the expressions into flat arrays, the tokens of expression i being at
+        offsets[i]:offsets[i+1]. With N tokens in total:
+            heads (N,): the head of each token in its expression, -1 for the root
+            post_order (N,): for each expression, an order of its tokens in which the children precede their head
+    """
+    lengths = np.array([len(h) for h in heads], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    expr_ids = np.repeat(np.arange(len(heads)), lengths)
+    flat = np.concatenate([np.asarray(h, dtype=np.int64) for h in heads]) if len(heads) > 0 else np.zeros(0, dtype=np.int64)
+    is_root = flat == -1
+    parents = np.where(is_root, -1, flat + offsets[:-1][expr_ids]) # global index of the head
+
+    # a deeper token is executed first
+    depth = np.zeros(len(flat), dtype=np.int64)
+    ancestor = parents.copy()
+    while (ancestor != -1).any():
+        depth += ancestor != -1
+        ancestor = np.where(ancestor != -1, parents[ancestor], -1)
+    post_order = np.lexsort((-depth, expr_ids))
+    post_order = post_order - offsets[:-1][expr_ids[post_order]]
+
+    return offsets, flat.astype(np.int16), post_order.astype(np.int16)
 
 class HINT(Dataset):
     def __init__(self, split='train', exclude_symbols=None, max_len=None, numSamples=None, fewshot=-1):
@@ -29,9 +51,13 @@ class HINT(Dataset):
             
         for x in self.dataset:
             x['len'] = len(x['expr'])
+
+        self.offsets, self.heads, self.post_order = pack_parses([x['head'] for x in self.dataset])
         
-        self.img_transform = IMG_TRANSFORM
-        self.valid_ids = list(range(len(self.dataset)))
+        # the ids of the active samples are kept in shared memory and changed in place by the filters,
+        # so that the persistent workers of a dataloader see them without being restarted
+        self.id_buffer = torch.arange(len(self.dataset)).share_memory_()
+        self.n_valid = len(self.dataset)
 
         # dataset statistics, used to filter samples
         len2ids = {}
@@ -73,28 +99,33 @@ class HINT(Dataset):
                 cond2ids[x['eval']].append(i)
             self.cond2ids = cond2ids
 
+    @property
+    def valid_ids(self):
+        return self.id_buffer[:self.n_valid].tolist()
+
+    @valid_ids.setter
+    def valid_ids(self, ids):
+        self.id_buffer[:len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        self.n_valid = len(ids)
+
     def __getitem__(self, index):
-        index = self.valid_ids[index]
+        index = int(self.id_buffer[index])
         sample = deepcopy(self.dataset[index])
-        img_seq = []
-        for img_path in sample['img_paths']:
-            img = Image.open(IMG_DIR+img_path).convert('L')
-            img = ImageOps.invert(img)
-            img = pad_image(img, 60)
-            img = transforms.functional.resize(img, 40)
-            img = self.img_transform(img)
-            img_seq.append(img)
+        img_seq = [load_image(IMG_DIR+img_path) for img_path in sample['img_paths']]
         # del sample['img_paths']
         sample['expr'] = ''.join(sample['expr'])
+        st, ed = self.offsets[index], self.offsets[index+1]
+        sample['head'] = self.heads[st:ed]
+        sample['post_order'] = self.post_order[st:ed]
         
-        sentence = [SYM2ID(sym) for sym in sample['expr']]
+        sentence = SYMBOL_TABLE.encode(sample['expr']).tolist()
         sample['img_seq'] = img_seq
         sample['sentence'] = sentence
         return sample
             
     
     def __len__(self):
-        return len(self.valid_ids)
+        return self.n_valid
 
     def filter_by_len(self, min_len=None, max_len=None):
         if min_len is None: min_len = -1
@@ -109,38 +140,43 @@ class HINT(Dataset):
 
     def all_symbols(self, max_len=float('inf')):
         dataset = [sample for sample in self.dataset if len(sample['expr']) <= max_len]
-        symbol_set = [(x,SYM2ID(y)) for sample in dataset for x, y in zip(sample['img_paths'], sample['expr'])]
+        symbol_set = [(x,y) for sample in dataset for x, y in zip(sample['img_paths'], SYMBOL_TABLE.encode(''.join(sample['expr'])).tolist())]
         return sorted(list(symbol_set))
 
+PAD_ID = -2 # padding of sentences and heads, neither a symbol nor a head (-1 is the root)
+LIST_KEYS = ['img_paths', 'res_all']
+PADDED_KEYS = ['sentence', 'head', 'post_order']
+
 def HINT_collate(batch):
-    img_seq_list = []
-    sentence_list = []
-    img_paths_list = []
-    head_list = []
-    res_all_list = []
-    for sample in batch:
-        img_seq_list.extend(sample['img_seq'])
-        del sample['img_seq']
-
-        img_paths_list.append(sample['img_paths'])
-        del sample['img_paths']
-
-        sentence_list.append(sample['sentence'])
-        del sample['sentence']
-
-        head_list.append(sample['head'])
-        del sample['head']
-
-        res_all_list.append(sample['res_all'])
-        del sample['res_all']
-        
-    batch = default_collate(batch)
-    batch['img_seq'] = torch.stack(img_seq_list)
-    batch['img_paths'] = img_paths_list
-    batch['sentence'] = sentence_list
-    batch['head'] = head_list
-    batch['res_all'] = res_all_list
-    return batch
+    # The images of the batch are written once into a single tensor, which is allocated in shared memory
+    # when collating in a worker (so it is passed to the main process without another copy),
+    # or in pinned memory when collating in the main process with CUDA.
+    # Sentences and heads are returned as padded int tensors, with the lengths in batch['len'].
+    lengths = [len(x['img_seq']) for x in batch]
+    images = [img for x in batch for img in x['img_seq']]
+    shape = (len(images),) + tuple(images[0].shape)
+    if get_worker_info() is not None:
+        img_seq = torch.empty(shape, dtype=images[0].dtype).share_memory_()
+    else:
+        img_seq = torch.empty(shape, dtype=images[0].dtype, pin_memory=torch.cuda.is_available())
+    torch.stack(images, out=img_seq)
+
+    padded = {k: torch.full((len(batch), max(lengths)), PAD_ID, dtype=torch.long) for k in PADDED_KEYS}
+    for i, (x, l) in enumerate(zip(batch, lengths)):
+        for k in PADDED_KEYS:
+            padded[k][i, :l] = torch.as_tensor(x[k], dtype=torch.long)
+
+    skipped = set(['img_seq'] + LIST_KEYS + PADDED_KEYS)
+    collated = default_collate([{k: v for k, v in x.items() if k not in skipped} for x in batch])
+    collated['img_seq'] = img_seq
+    for k in LIST_KEYS:
+        collated[k] = [x[k] for x in batch]
+    collated.update(padded)
+    return collated
+
+def unpad(padded, lengths):
+    # lists of the sentences or heads of a batch, from the padded tensor
+    return [x[:l].tolist() for x, l in zip(padded, lengths)]
 
 if __name__ == '__main__':
     val_set = HINT('val')
@@ -0,0 +1,62 @@
+import os
+import math
+import datetime
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def init(rank=None, world_size=None, backend='gloo'):
+    # rank and world size are given for local processes, or read from the environment (e.g. torch.distributed.launch)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    if rank is None:
+        rank = int(os.environ['RANK'])
+        world_size = int(os.environ['WORLD_SIZE'])
+    # rank 0 evaluates the model alone, the other ranks wait for it in the next collective
+    dist.init_process_group(backend, rank=rank, world_size=world_size, timeout=datetime.timedelta(hours=2))
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+class DistributedSampler(torch.utils.data.distributed.DistributedSampler):
+    # the dataset may be filtered in place between epochs, so its size is read again in set_epoch
+    def set_epoch(self, epoch):
+        super(DistributedSampler, self).set_epoch(epoch)
+        self.num_samples = int(math.ceil(len(self.dataset) / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+def data_parallel(model):
+    return DistributedDataParallel(model) if is_distributed() else model
+
+def broadcast_module(module):
+    for t in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(t.data, src=0)
+
+def broadcast_object(obj):
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
+
+def all_gather_object(obj):
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+def shard(data):
+    # the same number of items on every rank, so that all ranks run the same number of iterations,
+    # with fewer items than ranks the items are repeated so that every rank gets one
+    world_size = get_world_size()
+    if 0 < len(data) < world_size:
+        data = [data[i % len(data)] for i in range(world_size)]
+    n = len(data) // world_size
+    return data[get_rank()::world_size][:n]
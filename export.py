@@ -0,0 +1,78 @@
+"""
+Export a trained model to a self-contained inference bundle, loaded by runtime.Bundle.
+    python export.py --resume outputs/model_100.p --output outputs/bundle/
+The bundle directory contains:
+    perception.pt   the perception network, traced with TorchScript (and perception.onnx with --onnx)
+    parser.pt       the parser network, scripted with TorchScript
+    bundle.json     the symbols and the semantics; a learned semantics is stored as its program
+                    and its outputs on [0, table_max]^arity, a ground-truth semantics by its symbol
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+
+import torch
+
+from utils import SYMBOLS, IMG_SIZE, add_inference_args, load_inference_model
+from jointer import EXEC_ERRORS
+from runtime import ERROR
+
+def parse_args():
+    parser = argparse.ArgumentParser('Export a HINT model for inference')
+    add_inference_args(parser, decode=False)
+    parser.add_argument('--output', type=str, required=True, help='output directory of the bundle')
+    parser.add_argument('--table-max', type=int, default=100, help='inputs of the tabulated semantics are in [0, table_max]')
+    parser.add_argument('--onnx', action="store_true", help='also export the perception to ONNX')
+    args = parser.parse_args()
+    return args
+
+def export_semantics(smt, symbol, table_max, ground_truth=False):
+    if ground_truth:
+        return {'builtin': symbol}
+    if smt.program is None:
+        return None
+    program = smt.program
+    table = []
+    for xs in itertools.product(range(table_max + 1), repeat=program.arity):
+        try:
+            y = program(*xs)
+        except EXEC_ERRORS:
+            table.append(ERROR)
+            continue
+        table.append(None if y is None or y > sys.maxsize else y)
+    return {'arity': program.arity, 'table_max': table_max, 'table': table, 'program': str(program.prog)}
+
+def export(model, output_dir, table_max=100, ground_truth=False, onnx=False):
+    os.makedirs(output_dir, exist_ok=True)
+    model.to('cpu')
+    model.eval()
+
+    images = torch.zeros(2, 1, IMG_SIZE, IMG_SIZE)
+    perception = torch.jit.trace(model.perception.model, images)
+    perception.save(os.path.join(output_dir, 'perception.pt'))
+    if onnx:
+        torch.onnx.export(model.perception.model, images, os.path.join(output_dir, 'perception.onnx'),
+                          input_names=['images'], output_names=['logits'],
+                          dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}})
+
+    parser = torch.jit.script(model.syntax.model)
+    parser.save(os.path.join(output_dir, 'parser.pt'))
+
+    meta = {
+        'symbols': list(SYMBOLS),
+        'null': model.syntax.tok2id['<NULL>'],
+        'semantics': [export_semantics(smt, s, table_max, ground_truth)
+                      for s, smt in zip(SYMBOLS, model.semantics())],
+    }
+    with open(os.path.join(output_dir, 'bundle.json'), 'w') as f:
+        json.dump(meta, f)
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+
+    model = load_inference_model(args, 'cpu')
+    export(model, args.output, args.table_max, ground_truth=args.semantics, onnx=args.onnx)
+    print('Export the bundle to %s'%args.output)
@@ -1,10 +1,14 @@
 import perception, syntax, semantics
+import checkpoint
+import dist_utils
+from buffer import SampleBuffer
+from dataset import unpad
 import numpy as np
 from copy import deepcopy
 import sys
 from func_timeout import func_timeout, FunctionTimedOut
 from utils import SYMBOLS, DEVICE
-from collections import Counter, namedtuple
+from collections import Counter, namedtuple, defaultdict
 from time import time
 import torch
 from torch.distributions.categorical import Categorical
@@ -12,6 +16,42 @@ import random
 from heapq import heappush, heappop, heapify
 
 Parse = namedtuple('Parse', ['sentence', 'head'])
+abduce_stats = Counter() # number of candidates explored and found by the abduction, printed and reset in Jointer.learn
+
+EXEC_ERRORS = (IndexError, TypeError, ZeroDivisionError, ValueError, RecursionError)
+_inverse_tables = {}
+def inverse_values(smt, xs, j, target, max_value=100):
+    # values v in [0, max_value] such that smt(*xs[:j], v, *xs[j+1:]) == target, from a cached table of the outputs
+    program = getattr(smt, 'program', None)
+    if program is None:
+        return []
+    key = (str(program), tuple(xs[:j]), tuple(xs[j+1:]), max_value)
+    table = _inverse_tables.get(key)
+    if table is None:
+        table = defaultdict(list)
+        for v in range(max_value + 1):
+            try:
+                out = smt(*xs[:j], v, *xs[j+1:])
+            except EXEC_ERRORS:
+                continue
+            if out is not None:
+                table[out].append(v)
+        if len(_inverse_tables) > int(1e5):
+            _inverse_tables.clear()
+        _inverse_tables[key] = table
+    return table.get(target, [])
+
+def execute(smt, args):
+    # execute a semantics on the results of the children, as Node.res does, with errors giving None
+    try:
+        r = smt(*[x for x in args if x is not None])
+    except EXEC_ERRORS:
+        return None
+    return None if r is None or r > sys.maxsize else r
+
+def relabel_cost(smt):
+    # changing the output of a well-learned semantics is more expensive
+    return 1. + getattr(smt, 'likelihood', 0.) + float(getattr(smt, 'solved', False))
 
 class SentGenerator(object):
     def __init__(self, probs, training=False):
@@ -65,7 +105,9 @@ class Node:
         return True
 
 class AST: # Abstract Syntax Tree
-    def __init__(self, pt, semantics, sent_probs=None):
+    def __init__(self, pt, semantics, sent_probs=None, post_order=None):
+        # with post_order (children before heads, e.g. precomputed by HINT), the nodes are executed in this order
+        # instead of recursively from the root
         self.pt = pt
         self.semantics = semantics
         self.sent_probs = sent_probs
@@ -82,6 +124,9 @@ class AST: # Abstract Syntax Tree
         try:
             # TODO: set a timeout for the execution
             # self._res = func_timeout(timeout=0.01, func=root_node.res)
+            if post_order is not None:
+                for k in post_order:
+                    nodes[k].res()
             self._res = self.root_node.res() 
         except (IndexError, TypeError, ZeroDivisionError, ValueError, RecursionError, FunctionTimedOut) as e:
             # Must be extremely careful about these errors
@@ -94,7 +139,22 @@ class AST: # Abstract Syntax Tree
 
     def res_all(self): return [nd._res for nd in self.nodes]
 
-    def abduce(self, y, module=None):
+    def tree(self):
+        # children lists built from the head array, and the result of each node executed on its own,
+        # i.e., a failed node gives None instead of failing the whole tree. Used for incremental evaluation.
+        head = self.pt.head
+        children = [[] for _ in self.nodes]
+        for k, h in enumerate(head):
+            if h != -1:
+                children[h].append(k)
+        values = [None] * len(self.nodes)
+        def evaluate(k):
+            values[k] = execute(self.nodes[k].smt, [evaluate(c) for c in children[k]])
+            return values[k]
+        evaluate(head.index(-1))
+        return children, values
+
+    def abduce(self, y, module=None, perception_budget=100):
         if self._res is not None and self._res == y:
             return self
         
@@ -103,77 +163,205 @@ class AST: # Abstract Syntax Tree
             if et is not None:
                 return et
         elif module == 'perception':
-            et = self.abduce_perception(y)
+            et = self.abduce_perception(y, budget=perception_budget)
+            if et is not None:
+                return et
+        elif module == 'syntax':
+            et = self.abduce_syntax(y)
             if et is not None:
                 return et
-        # elif module == 'syntax':
-        #     et = self.abduce_syntax(y)
-        #     if et is not None:
-        #         return et
         
         return None
 
         
-    def abduce_semantics(self, y):
-        # abduce over semantics
-        # Currently, if the root node's children are valid, we directly change the result to y
-        # In future, we can consider to search the execution tree in a top-down manner
-        if self.root_node is not None and self.root_node.children_res_valid():
-            self._res = y
-            self.root_node._res = y
-            return self
-        return None
-
-    def abduce_perception(self, y):
-        # abduce over sentence
-        epsilon = -1
-        sent_pos_list = np.argsort([self.sent_probs[i, s] for i, s in enumerate(self.pt.sentence)])
-        for sent_pos in sent_pos_list:
-            s_prob = self.sent_probs[sent_pos]
-            if s_prob[self.pt.sentence[sent_pos]] >= 1 - epsilon:
-                break
-            for sym in np.argsort(s_prob)[::-1]:
-                if s_prob[sym] < epsilon:
-                    break
-                sentence = deepcopy(self.pt.sentence)
-                sentence[sent_pos] = sym
-                et = AST(Parse(sentence, self.pt.head), self.semantics)
-                if et.res() is not None and et.res() == y:
+    def abduce_semantics(self, y, budget=100, max_value=100):
+        # abduce over semantics by searching the execution tree in a top-down manner:
+        # the target value is propagated from a node to one of its children through the inverse of the node's semantics,
+        # or the output of the node is directly changed to the target (if its children are valid).
+        # The cheapest solution is kept, and at most `budget` (node, target) pairs are explored.
+        if self.root_node is None:
+            return None
+        index = {id(nd): i for i, nd in enumerate(self.nodes)}
+        memo = {}
+        explored = [0]
+
+        def search(node, target):
+            # returns (cost, {node index: new output}) or None
+            key = (id(node), target)
+            if key in memo:
+                return memo[key]
+            if explored[0] >= budget:
+                return None
+            explored[0] += 1
+
+            if node._res == target:
+                memo[key] = (0., {})
+                return memo[key]
+            best = None
+            if node.children_res_valid():
+                best = (relabel_cost(node.smt), {index[id(node)]: target})
+            args = [ch for ch in node.children if ch._res is not None]
+            xs = [ch._res for ch in args]
+            for j, child in enumerate(args):
+                for v in inverse_values(node.smt, xs, j, target, max_value):
+                    sub = search(child, v)
+                    if sub is not None and (best is None or sub[0] < best[0]):
+                        best = (sub[0], dict(sub[1]))
+                        best[1][index[id(node)]] = target
+            memo[key] = best
+            return best
+
+        best = search(self.root_node, y)
+        abduce_stats['semantics_explored'] += explored[0]
+        if best is None:
+            return None
+        abduce_stats['semantics_found'] += 1
+        # a new AST is returned, since this one may be reused by the deduction cache
+        et = AST(self.pt, self.semantics, self.sent_probs)
+        for i, v in best[1].items():
+            et.nodes[i]._res = v
+        et._res = y
+        return et
+
+    def abduce_perception(self, y, budget=100):
+        # abduce over sentence: all the substitutions of one symbol are tried first, as the single-position loop
+        # did, in order of the decrease of the joint log-probability of the sentence. Only if none of them fits,
+        # up to `budget` substitutions of two symbols are tried by best-first search: with the single ones
+        # sorted by cost, a pair (a, b) (a < b) is expanded into (a, b+1), and also (a+1, a+2) if b == a+1,
+        # so the pairs are popped in order of cost.
+        # A candidate re-executes only the substituted nodes and their ancestors, except the most probable one,
+        # which fits most of the time and is executed as a whole before the tree of results is built.
+        if self.sent_probs is None:
+            return None
+        sentence = self.pt.sentence
+        head = self.pt.head
+        # the cost of a substitution is log p(current symbol) - log p(new symbol), the singles are sorted by its ratio
+        probs = self.sent_probs + 1e-12
+        rows = np.arange(len(sentence))
+        ratios = probs[rows, sentence][:, None] / probs
+        ratios[rows, sentence] = np.inf
+        flat = np.argsort(ratios, axis=None)[:ratios.size - len(sentence)].tolist() # the current symbols are last
+        n_symbols = ratios.shape[1]
+        if not flat:
+            return None
+        children = values = None
+
+        def evaluate(subs):
+            # result of the tree with the substitutions {position: symbol}
+            dirty = set()
+            for k in subs:
+                while k != -1 and k not in dirty:
+                    dirty.add(k)
+                    k = head[k]
+            def run(k):
+                if k not in dirty:
+                    return values[k]
+                smt = self.semantics[subs[k]] if k in subs else self.nodes[k].smt
+                return execute(smt, [run(c) for c in children[k]])
+            return run(head.index(-1))
+
+        def accept(subs):
+            new_sentence = list(sentence)
+            for k, sym in subs.items():
+                new_sentence[k] = sym
+            et = AST(Parse(new_sentence, head), self.semantics, self.sent_probs)
+            return et if et.res() is not None and et.res() == y else None
+
+        explored = 0
+        for f in flat:
+            k, sym = divmod(f, n_symbols)
+            explored += 1
+            if explored == 1:
+                res = y
+            else:
+                if children is None:
+                    children, values = self.tree()
+                res = evaluate({k: sym})
+            if res is not None and res == y:
+                et = accept({k: sym})
+                if et is not None:
+                    abduce_stats['perception_explored'] += explored
+                    abduce_stats['perception_found'] += 1
                     return et
-        return None
 
-    def abduce_syntax(self, y):
-        # abduce syntax by rotating the tree w.r.t the root node
-        arcs = self.pt.dependencies
-        def get_lc(k):
-            return sorted([arc[1] for arc in arcs if arc[0] == k and arc[1] < k])
+        if children is None:
+            children, values = self.tree()
+        singles = [divmod(f, n_symbols) for f in flat] # (position, symbol)
+        single_costs = np.log(ratios.flat[flat]).tolist()
+        queue = [(single_costs[0] + single_costs[1], (0, 1))] if len(singles) > 1 else []
+        n_pairs = 0
+        while queue and n_pairs < budget:
+            _, (a, b) = heappop(queue)
+            if b + 1 < len(singles):
+                heappush(queue, (single_costs[a] + single_costs[b+1], (a, b+1)))
+            if b == a + 1 and a + 2 < len(singles):
+                heappush(queue, (single_costs[a+1] + single_costs[a+2], (a+1, a+2)))
+            if singles[a][0] == singles[b][0]: # two substitutions at the same position
+                continue
+            n_pairs += 1
+            subs = dict([singles[a], singles[b]])
+            res = evaluate(subs)
+            if res is None or res != y:
+                continue
+            et = accept(subs)
+            if et is not None:
+                abduce_stats['perception_explored'] += explored + n_pairs
+                abduce_stats['perception_found'] += 1
+                return et
 
-        def get_rc(k):
-            return sorted([arc[1] for arc in arcs if arc[0] == k and arc[1] > k], reverse=True)
+        abduce_stats['perception_explored'] += explored + n_pairs
+        return None
 
-        epsilon = 0
-        for arc in sorted(arcs, key=lambda x: x[2]):
-            h, t, p = arc
+    def abduce_syntax(self, y, epsilon=0.):
+        # abduce syntax by rotating the tree w.r.t. an arc (h, t), i.e., t becomes the parent of h.
+        # Arcs are tried from the least confident one. A rotation only changes the children of h and t,
+        # so the candidate is evaluated incrementally: h, t and the ancestors of h are re-executed,
+        # and the other subtrees reuse their results in the current tree.
+        arcs = getattr(self.pt, 'dependencies', None)
+        if not arcs:
+            return None
+        head = self.pt.head
+        children, values = self.tree()
+        run = lambda k, args: execute(self.nodes[k].smt, args)
+
+        explored = 0
+        for h, t, p in sorted(arcs, key=lambda x: x[2]):
             if p >= 1 - epsilon:
                 break
-            head = deepcopy(self.pt.head)
-
-            head[t] = head[h]
-            head[h] = t 
-
-            children = get_rc(h) if h < t else get_lc(h)
-            for j in children[:children.index(t)]:
-                head[j] = t
-
-            children = get_lc(t) if h < t else get_rc(t)
-            for j in children:
-                head[j] = h
+            explored += 1
+            # children of h beyond t are moved to t, children of t between h and t are moved to h
+            if h < t:
+                outer = [c for c in children[h] if c > t]
+                inner = [c for c in children[t] if c < t]
+            else:
+                outer = [c for c in children[h] if c < t]
+                inner = [c for c in children[t] if c > t]
+            h_children = sorted([c for c in children[h] if c != t and c not in outer] + inner)
+            t_children = sorted([c for c in children[t] if c not in inner] + [h] + outer)
+
+            res_h = run(h, [values[c] for c in h_children])
+            res = run(t, [res_h if c == h else values[c] for c in t_children])
+            child, k = h, head[h]
+            while k != -1:
+                res = run(k, [res if c == child else values[c] for c in children[k]])
+                child, k = k, head[k]
+            if res is None or res != y:
+                continue
 
-            et = AST(Parse(self.pt.sentence, head), self.semantics)
+            new_head = list(head)
+            new_head[t] = head[h]
+            new_head[h] = t
+            for c in outer:
+                new_head[c] = t
+            for c in inner:
+                new_head[c] = h
+            et = AST(Parse(self.pt.sentence, new_head), self.semantics, self.sent_probs)
             if et.res() is not None and et.res() == y:
+                abduce_stats['syntax_explored'] += explored
+                abduce_stats['syntax_found'] += 1
                 return et
 
-
+        abduce_stats['syntax_explored'] += explored
         return None
 
     
@@ -185,8 +373,13 @@ class Jointer:
         self.syntax = syntax.build(config)
         self.semantics = semantics.build(config)
         self.ASTs = []
-        self.buffer = []
+        self.buffer = SampleBuffer()
         self.epoch = 0
+        self.checkpointer = checkpoint.Checkpointer(self)
+        self.deduce_cache = {} # batch -> deduced ASTs and outputs, valid for the module versions in deduce_cache_key
+        self.deduce_cache_key = None
+        self.deduce_cache_size = 256 # batches, the oldest one is dropped first
+        self.perception_budget = getattr(config, 'perception_budget', 100) # pairs of substitutions of the perception abduction
         self.learning_schedule = ['semantics'] * (0 if config.semantics else 1) \
                                + ['perception'] * (0 if config.perception else 1) \
                                + ['syntax'] * (0 if config.syntax else 10) \
@@ -196,14 +389,14 @@ class Jointer:
         return self.learning_schedule[self.epoch % len(self.learning_schedule)]
 
     def save(self, save_path, epoch=None):
-        model = {'epoch': epoch}
-        model['perception'] = self.perception.save()
-        model['syntax'] = self.syntax.save()
-        model['semantics'] = self.semantics.save()
-        torch.save(model, save_path)
-
-    def load(self, load_path):
-        model = torch.load(load_path)
+        # saved in background, only the modules changed since the last save are written
+        self.checkpointer.save(save_path, epoch)
+
+    def wait_saving(self):
+        self.checkpointer.wait()
+
+    def load(self, load_path, map_location=None):
+        model = checkpoint.load(load_path, map_location=map_location)
         self.perception.load(model['perception'])
         self.syntax.load(model['syntax'])
         self.semantics.load(model['semantics'])
@@ -237,59 +430,92 @@ class Jointer:
         self.perception.eval()
         self.syntax.eval()
         # self.semantics.eval()
+        self.clear_deduce_cache()
 
     def to(self, device):
         self.perception.to(device)
         self.syntax.to(device)
+
+    def broadcast_parameters(self):
+        # start all the ranks from the same model
+        dist_utils.broadcast_module(self.perception.model)
+        dist_utils.broadcast_module(self.syntax.model)
     
-    def deduce(self, sample, n_steps=1):
+    def module_versions(self):
+        return (self.perception.version, self.syntax.version, self.semantics.program_version,
+                self.perception.training, self.syntax.model.training)
+
+    def clear_deduce_cache(self):
+        self.deduce_cache = {}
+        self.deduce_cache_key = None
+
+    def deterministic(self):
+        # the perception and the parser sample their outputs in training, unless the ground truth is used
+        return (self.config.perception or not self.perception.training) \
+           and (self.config.syntax or not self.syntax.model.training)
+
+    def deduce(self, sample, n_steps=1, use_cache=False):
+        # with use_cache, a batch deduced before with the same module versions reuses the previous outputs,
+        # as long as the outputs are deterministic: the sampled ones are deduced again to keep the exploration
+        use_cache = use_cache and self.deterministic()
+        if use_cache:
+            key = self.module_versions() + (n_steps,)
+            if key != self.deduce_cache_key:
+                self.deduce_cache = {}
+                self.deduce_cache_key = key
+            batch_key = tuple(map(tuple, sample['img_paths']))
+            if batch_key in self.deduce_cache:
+                self.ASTs, outputs = self.deduce_cache[batch_key]
+                return outputs
+
         config = self.config
         img_seq = sample['img_seq']
         lengths = sample['len']
         img_seq = img_seq.to(DEVICE)
 
         if config.perception: # use gt perception
-            sentences = sample['sentence']
+            sentences = unpad(sample['sentence'], lengths)
             sent_probs = []
             for sent, l in zip(sentences, lengths):
                 probs = np.zeros((l, len(SYMBOLS)))
                 probs[range(l), sent] = 1
                 sent_probs.append(probs)
         else:
+            # the perception already gives the top-1 (or sampled, in training) symbols of the whole batch,
+            # which are the sentences of the first step
             symbols , probs = self.perception(img_seq)
-            symbols = symbols.detach().cpu().numpy()
-            probs = probs.detach().cpu().numpy()
-
-            sentences = []
-            sent_probs = []
-            current = 0
-            for l in lengths:
-                sentences.append(list(symbols[current:current+l]))
-                sent_probs.append(probs[current:current+l])
-                current += l
+            splits = np.cumsum(lengths)[:-1]
+            sentences = [x.tolist() for x in np.split(symbols.detach().cpu().numpy(), splits)]
+            sent_probs = np.split(probs.detach().cpu().numpy(), splits)
 
         semantics = self.semantics()
         self.ASTs = [None] * len(lengths)
-        sent_generators = [SentGenerator(probs, self.perception.training) for probs in sent_probs]
+        # generators are only created for the samples that need a second step
+        sent_generators = {}
         unfinished = list(range(len(lengths)))
         for t in range(n_steps):
-            sentences = [sent_generators[i].next() for i in unfinished]
-            not_none = [i for i, s in enumerate(sentences) if s is not None]
-            unfinished = [unfinished[i] for i in not_none]
-            sentences = [sentences[i] for i in not_none]
-            if config.syntax: # use gt parse
-                parses = []
-                for i, s in zip(unfinished, sentences):
-                    head = sample['head'][i]
-                    pt = syntax.PartialParse(s)
-                    pt.head = head
-                    parses.append(pt)
+            if t > 0:
+                for i in unfinished:
+                    if i not in sent_generators:
+                        sent_generators[i] = SentGenerator(sent_probs[i], self.perception.training)
+                        if not self.perception.training:
+                            sent_generators[i].next() # the top-1 sentence is used in the first step
+                sentences = [sent_generators[i].next() for i in unfinished]
+                not_none = [i for i, s in enumerate(sentences) if s is not None]
+                unfinished = [unfinished[i] for i in not_none]
+                sentences = [sentences[i] for i in not_none]
+            post_orders = [None] * len(lengths)
+            if config.syntax: # use gt parse, with the execution orders precomputed by the dataset
+                heads = unpad(sample['head'], lengths)
+                parses = [Parse(s, heads[i]) for i, s in zip(unfinished, sentences)]
+                if 'post_order' in sample:
+                    post_orders = unpad(sample['post_order'], lengths)
             else:
                 parses = self.syntax(sentences)
             
             tmp = []
             for i, pt in zip(unfinished, parses):
-                ast = AST(pt, semantics, sent_probs[i])
+                ast = AST(pt, semantics, sent_probs[i], post_orders[i])
                 if ast.res() is None:
                     tmp.append(i)
                 if self.ASTs[i] is None or ast.res() is not None:
@@ -301,34 +527,75 @@ class Jointer:
         results = [ast.res() for ast in self.ASTs]
         head = [ast.pt.head for ast in self.ASTs]
         sentences = [ast.pt.sentence for ast in self.ASTs]
+        if use_cache:
+            if len(self.deduce_cache) >= self.deduce_cache_size:
+                del self.deduce_cache[next(iter(self.deduce_cache))]
+            self.deduce_cache[batch_key] = (self.ASTs, (results, sentences, head))
         return results, sentences, head
 
     def abduce(self, gt_values, batch_img_paths):
         for et, y, img_paths in zip(self.ASTs, gt_values, batch_img_paths):
-            new_et = et.abduce(int(y), self.learned_module)
+            new_et = et.abduce(int(y), self.learned_module, self.perception_budget)
             if new_et: 
-                new_et.img_paths = img_paths
-                self.buffer.append(new_et)
+                self.buffer.append_ast(new_et, img_paths)
+                if self.learned_module == 'semantics' and dist_utils.get_rank() == 0:
+                    self.add_semantics_examples(new_et.pt.sentence, new_et.pt.head, new_et.res_all())
+
+    def add_semantics_examples(self, sentence, head, results):
+        # examples are accumulated in the semantics module as soon as a sample is abduced
+        children = [[] for _ in sentence]
+        for i, h in enumerate(head):
+            if h != -1:
+                children[h].append(i)
+        for i, symbol in enumerate(sentence):
+            xs = tuple([results[c] for c in children[i] if results[c] is not None])
+            self.semantics.add_example(symbol, xs, results[i])
+
+    def sync_buffer(self):
+        # gather the abduced samples of all ranks, so that every rank learns from the same buffer
+        rank = dist_utils.get_rank()
+        encoded = dist_utils.all_gather_object(self.buffer.encode())
+        buffer = SampleBuffer()
+        for r, enc in enumerate(encoded):
+            if r == rank:
+                buffer.extend(self.buffer)
+                continue
+            received = SampleBuffer.decode(enc)
+            buffer.extend(received)
+            if self.learned_module == 'semantics' and rank == 0:
+                for sentence, head, results, _ in received:
+                    self.add_semantics_examples(sentence, head, results)
+        self.buffer = buffer
     
     def clear_buffer(self):
-        self.buffer = []
+        self.buffer = SampleBuffer()
 
     def learn(self):
+        if dist_utils.is_distributed():
+            self.sync_buffer()
         if len(self.buffer) == 0: 
             return
 
         self.train()
-        print("Hit samples: ", len(self.buffer), ' Ave length: ', round(np.mean([len(x.pt.sentence) for x in self.buffer]), 2))
-        pred_symbols = Counter([y for x in self.buffer for y in x.pt.sentence])
-        print("Symbols: ", len(pred_symbols), sorted(pred_symbols.items()))
-        pred_heads = Counter([tuple(ast.pt.head) for ast in self.buffer])
+        print("Hit samples: ", len(self.buffer), ' Ave length: ', round(np.mean(self.buffer.lengths()), 2))
+        pred_symbols = [(s, int(c)) for s, c in enumerate(self.buffer.symbol_counts()) if c > 0]
+        print("Symbols: ", len(pred_symbols), pred_symbols)
+        parses = self.buffer.parses()
+        pred_heads = Counter([tuple(head) for _, head in parses])
         print("Head: ", sorted(pred_heads.most_common(10), key=lambda x: len(x[0])))
+        print("Abduction: ", sorted(abduce_stats.items()))
+        abduce_stats.clear()
 
         if self.config.fewshot != -1:
-            self.buffer = self.buffer + random.sample(self.buffer_augment, k=1000)
+            buffer_augment = self.buffer_augment.sample(k=1000)
+            self.buffer.extend(buffer_augment)
+            parses = self.buffer.parses()
+            if self.learned_module == 'semantics' and dist_utils.get_rank() == 0:
+                for sentence, head, results, _ in buffer_augment:
+                    self.add_semantics_examples(sentence, head, results)
 
         if self.learned_module == 'perception':
-            dataset = [(img, label) for x in self.buffer for img, label in zip(x.img_paths, x.pt.sentence)]
+            dataset = self.buffer.symbol_images()
             n_iters = int(100)
             print("Learn perception with %d samples for %d iterations, "%(len(self.buffer), n_iters), end='', flush=True)
             st = time()
@@ -336,7 +603,7 @@ class Jointer:
             print("take %d sec."%(time()-st))
 
         elif self.learned_module == 'syntax':
-            dataset = [x.pt for x in self.buffer]
+            dataset = [Parse(sentence, head) for sentence, head in parses]
             n_iters = int(100)
             print("Learn syntax with %d samples for %d iterations, "%(len(self.buffer), n_iters), end='', flush=True)
             st = time()
@@ -344,15 +611,17 @@ class Jointer:
             print("take %d sec."%(time()-st))
 
         elif self.learned_module == 'semantics':
-            dataset = [[] for _ in range(len(self.semantics.semantics))]
-            for ast in self.buffer:
-                for node in ast.nodes:
-                    xs = tuple([x.res() for x in node.children if x.res() is not None])
-                    y = node.res()
-                    dataset[node.symbol].append((xs, y))
-            self.semantics.learn(dataset)
+            # semantics is learned on rank 0, and then sent to the other ranks
+            rank = dist_utils.get_rank()
+            if rank == 0:
+                self.semantics.learn()
+            if dist_utils.is_distributed():
+                model = dist_utils.broadcast_object(self.semantics.save() if rank == 0 else None)
+                if rank != 0:
+                    self.semantics.load(model)
 
         self.clear_buffer()
+        self.clear_deduce_cache()
 
 if __name__ == '__main__':
     # from utils import SEMANTICS
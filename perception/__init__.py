@@ -2,4 +2,4 @@
 from .perception import Perception
 
 def build(config):
-    return Perception()
+    return Perception(bf16=getattr(config, 'bf16', False))
@@ -1,31 +1,39 @@
-from utils import SYMBOLS, IMG_TRANSFORM, IMG_DIR, pad_image
+from utils import SYMBOLS, IMG_DIR, load_image
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions.categorical import Categorical
-from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
-from PIL import Image, ImageOps
+from torch.utils.data import Dataset, DataLoader, Sampler
 from tqdm import trange, tqdm
 import math
 import numpy as np
 from collections import Counter
 from . import resnet_scan, lenet_scan
-from torchvision import transforms
+import dist_utils
 import random
 
 tok_convert = {'*': 'times', '/': 'div', 'a': 'alpha', 'b': 'beta', 'c': 'gamma', 'd': 'phi', 'e': 'theta'}
 tok_convert = {v:k for k, v in tok_convert.items()}
 def check_accuarcy(dataset):
-    from utils import SYM2ID
+    from utils import SYMBOL_TABLE
     symbols = [x[0].split('/')[0] for x in dataset]
     symbols = [tok_convert.get(x, x) for x in symbols]
-    symbols = [SYM2ID(x) for x in symbols]
+    symbols = SYMBOL_TABLE.encode(''.join(symbols))
     labels = [x[1] for x in dataset]
     acc = np.mean(np.array(symbols) == np.array(labels))
     print(acc, end=', ')
 
+def bf16_supported():
+    # bfloat16 autocast on CPU needs bfloat16 kernels for convolutions, otherwise the model runs in fp32
+    try:
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            nn.Conv2d(1, 1, 3)(torch.zeros(1, 1, 8, 8)).float().sum().backward()
+        return True
+    except RuntimeError:
+        return False
+
 class Perception(object):
-    def __init__(self):
+    def __init__(self, bf16=False):
         super(Perception, self).__init__()
         self.n_class = len(SYMBOLS)
         # self.model = SymbolNet(self.n_class)
@@ -36,6 +44,13 @@ class Perception(object):
         self.training = False
         self.min_examples = 200
         self.selflabel_dataset = None
+        self.version = 0 # increased whenever the model changes
+        self.sampler = SymbolSampler()
+        self.loader = None
+        # bfloat16 autocast of the forward passes on CPU, the weights and the optimizer states stay in fp32
+        self.bf16 = bf16 and bf16_supported()
+        if bf16 and not self.bf16:
+            print("bfloat16 is not supported on this CPU, the perception runs in fp32.")
     
     def train(self):
         # self.model.train()
@@ -60,22 +75,37 @@ class Perception(object):
         self.model.load_state_dict(loaded['model'])
         if 'optimizer' in loaded:
             self.optimizer.load_state_dict(loaded['optimizer'])
+        self.version += 1
 
     def extend(self, n):
+        self.version += 1
         self.n_class += n
         self.model.extend(n)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=1e-4)
 
+    def autocast(self):
+        enabled = self.bf16 and torch.device(self.device).type == 'cpu'
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+    def image_loader(self, symbols, weights=None, n_samples=None):
+        # a single loader with persistent workers, which are sent the (image path, label) pairs to load,
+        # so that they are started only once for all the calls of learn and selflabel
+        if self.loader is None:
+            self.loader = torch.utils.data.DataLoader(ImageSet(), batch_size=512, sampler=self.sampler,
+                             num_workers=8, persistent_workers=True)
+        self.sampler.set(symbols, weights, n_samples)
+        return self.loader
+
     def selflabel(self, symbols):
-        dataloader = torch.utils.data.DataLoader(ImageSet(symbols), batch_size=512,
-                         shuffle=False, drop_last=False, num_workers=8)
+        dataloader = self.image_loader(symbols)
         with torch.no_grad():
             self.eval()
             prob_all = []
             for img, _ in dataloader:
                 img = img.to(self.device)
-                prob = self.model(img)
-                prob = nn.functional.softmax(prob, dim=-1)
+                with self.autocast():
+                    prob = self.model(img)
+                prob = nn.functional.softmax(prob.float(), dim=-1)
                 prob_all.append(prob)
             prob_all = torch.cat(prob_all)
         
@@ -99,7 +129,9 @@ class Perception(object):
 
     
     def __call__(self, images):
-        logits = self.model(images)
+        with self.autocast():
+            logits = self.model(images)
+        logits = logits.float()
         # probs = torch.sigmoid(logits)
         probs = nn.functional.softmax(logits, dim=-1)
         if self.training:
@@ -112,6 +144,7 @@ class Perception(object):
 
 
     def learn(self, dataset, n_iters=100):
+        self.version += 1
         batch_size = 512
         labels = [l for i, l in dataset]
         counts = Counter(labels)
@@ -127,23 +160,24 @@ class Perception(object):
         labels = [l for i, l in dataset]
         counts = Counter(labels)
         sample_weights = np.array([1. / counts[l] for i, l in dataset])
-        sampler = WeightedRandomSampler(torch.from_numpy(sample_weights), len(sample_weights))
+        # each rank draws its share of the samples in an epoch, the gradients are averaged across ranks
+        n_samples = int(math.ceil(len(sample_weights) / dist_utils.get_world_size()))
         criterion = nn.CrossEntropyLoss()
         # criterion = nn.BCEWithLogitsLoss(pos_weight=class_weights, reduction='none')
 
         n_epochs = int(math.ceil(batch_size * n_iters / len(dataset)))
         print(n_epochs, "epochs, ", end='')
-        dataset = ImageSet(dataset)
-        train_dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
-                         sampler=sampler, num_workers=8)
+        train_dataloader = self.image_loader(dataset, torch.from_numpy(sample_weights), n_samples)
         self.model.train()
+        model = dist_utils.data_parallel(self.model)
         for epoch in range(n_epochs):
             for img, label in train_dataloader:
                 img = img.to(self.device)
                 label = label.to(self.device)
-                logit = self.model(img)
+                with self.autocast():
+                    logit = model(img)
                 # label = nn.functional.one_hot(label, num_classes=self.n_class).type_as(logit)
-                loss = criterion(logit, label)
+                loss = criterion(logit.float(), label)
                 self.optimizer.zero_grad()
                 loss.backward()
                 self.optimizer.step()
@@ -167,21 +201,37 @@ class SymbolNet(nn.Module):
         x = self.fc3(x)
         return x
 
+class SymbolSampler(Sampler):
+    """ Yield (image path, label) pairs instead of indices, sequentially, or drawn with replacement
+        in proportion to the weights. The pairs are changed by `set` between two iterations.
+    """
+    def __init__(self):
+        self.set([])
+
+    def set(self, symbols, weights=None, n_samples=None):
+        self.symbols = symbols
+        self.weights = weights
+        self.n_samples = len(symbols) if n_samples is None else n_samples
+
+    def __iter__(self):
+        if self.weights is None:
+            return iter(self.symbols)
+        ids = torch.multinomial(self.weights, self.n_samples, replacement=True).tolist()
+        return iter([self.symbols[i] for i in ids])
+
+    def __len__(self):
+        return self.n_samples
+
 class ImageSet(Dataset):
-    def __init__(self, dataset):
+    # without a dataset, the index is the (image path, label) pair itself
+    def __init__(self, dataset=None):
         super(ImageSet, self).__init__()
         self.dataset = dataset
-        self.img_transform = IMG_TRANSFORM
 
     def __getitem__(self, index):
-        sample = self.dataset[index]
+        sample = index if self.dataset is None else self.dataset[index]
         img_path, label = sample
-        img = Image.open(IMG_DIR+img_path).convert('L')
-        img = ImageOps.invert(img)
-        img = pad_image(img, 60)
-        img = transforms.functional.resize(img, 40)
-        img = self.img_transform(img)
-
+        img = load_image(IMG_DIR+img_path)
         return img, label
 
     def __len__(self):
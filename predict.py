@@ -0,0 +1,136 @@
+"""
+Score a corpus of expressions with a trained model, streaming JSONL in and out.
+    python predict.py --resume outputs/model_100.p --input exprs.jsonl --output preds.jsonl
+    cat exprs.jsonl | python predict.py --resume outputs/model_100.p --output preds.jsonl
+Each input line is {"id": ..., "img_paths": [...]}, with an optional ground-truth "res".
+Each output line is {"id": ..., "result": ..., "sentence": ..., "head": [...]}, plus "correct" if "res" is given,
+or {"id": ..., "error": ...} if the line cannot be read (malformed JSON, missing or unreadable images).
+Predictions are appended to the output as they are made, and the ids already predicted in the output are skipped,
+so an interrupted run can be resumed with the same command (the lines that failed are tried again).
+"""
+import argparse
+import json
+import os
+import sys
+
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from tqdm import tqdm
+
+from utils import ID2SYM, IMG_DIR, load_image, add_inference_args, load_inference_model
+
+def parse_args():
+    parser = argparse.ArgumentParser('Batch inference for HINT')
+    add_inference_args(parser)
+    parser.add_argument('--input', type=str, default='-', help='input jsonl file, "-" for stdin')
+    parser.add_argument('--output', type=str, required=True, help='output jsonl file, predictions are appended to it')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--num-workers', type=int, default=4, help='number of dataloader workers, stdin is read with 0 workers')
+    args = parser.parse_args()
+    return args
+
+def read_done_ids(path):
+    # ids of the predictions already written, a partial last line (from an interrupted run) is removed.
+    # The lines that failed to be read are not done, they are tried again
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            end += len(line)
+            record = json.loads(line)
+            if 'error' not in record:
+                done.add(record['id'])
+        f.truncate(end)
+    return done
+
+def read_images(img_paths):
+    if len(img_paths) == 0:
+        raise ValueError('empty expression')
+    return torch.stack([load_image(p if os.path.isabs(p) else IMG_DIR + p) for p in img_paths])
+
+class JsonlExprs(IterableDataset):
+    def __init__(self, path, skip_ids=None):
+        super(JsonlExprs, self).__init__()
+        self.path = path
+        self.skip_ids = skip_ids or set()
+
+    def __iter__(self):
+        worker = get_worker_info()
+        n_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        f = sys.stdin if self.path == '-' else open(self.path)
+        try:
+            for i, line in enumerate(f):
+                if i % n_workers != worker_id or not line.strip():
+                    continue
+                id = i
+                try:
+                    sample = json.loads(line)
+                    id = sample.setdefault('id', i)
+                    if id in self.skip_ids:
+                        continue
+                    sample['img_seq'] = read_images(sample['img_paths'])
+                except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+                    # the line is reported as an error, as the 400 responses of serve.py, and the run goes on
+                    sample = {'id': id, 'error': str(e)}
+                yield sample
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+def predict_collate(batch):
+    errors = [x for x in batch if 'error' in x]
+    batch = [x for x in batch if 'error' not in x]
+    return {
+        'errors': errors,
+        'id': [x['id'] for x in batch],
+        'res': [x.get('res') for x in batch],
+        'img_seq': torch.cat([x['img_seq'] for x in batch]) if batch else None,
+        'len': [len(x['img_seq']) for x in batch],
+    }
+
+def predict(model, dataloader, fout):
+    n_samples = n_correct = n_labeled = n_errors = 0
+    with torch.no_grad():
+        for sample in tqdm(dataloader):
+            for error in sample['errors']:
+                fout.write(json.dumps(error) + '\n')
+            n_errors += len(sample['errors'])
+            if len(sample['id']) == 0:
+                fout.flush()
+                continue
+            results, sentences, heads = model.deduce(sample)
+            for id, gt, res, sent, head in zip(sample['id'], sample['res'], results, sentences, heads):
+                pred = {'id': id, 'result': None if res is None else int(res),
+                        'sentence': ''.join(map(ID2SYM, sent)), 'head': [int(h) for h in head]}
+                if gt is not None:
+                    pred['correct'] = pred['result'] == gt
+                    n_correct += pred['correct']
+                    n_labeled += 1
+                fout.write(json.dumps(pred) + '\n')
+            fout.flush()
+            n_samples += len(results)
+    print('Predict %d samples.'%n_samples, end=' ')
+    if n_errors > 0:
+        print('Fail to read %d samples.'%n_errors, end=' ')
+    if n_labeled > 0:
+        print('Result Acc=%.2f on %d labeled samples.'%(100 * n_correct / n_labeled, n_labeled), end='')
+    print()
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+
+    model = load_inference_model(args)
+
+    done = read_done_ids(args.output)
+    if done:
+        print('Skip %d samples already in %s.'%(len(done), args.output))
+    num_workers = 0 if args.input == '-' else args.num_workers
+    dataloader = DataLoader(JsonlExprs(args.input, skip_ids=done), batch_size=args.batch_size,
+                            num_workers=num_workers, collate_fn=predict_collate)
+    with open(args.output, 'a') as fout:
+        predict(model, dataloader, fout)
@@ -0,0 +1,139 @@
+"""
+Inference runtime for the bundles written by export.py, without the training stack.
+    from runtime import Bundle, load_image
+    bundle = Bundle('outputs/bundle/')
+    img_seq = torch.stack([load_image(p) for p in img_paths])
+    results, sentences, heads = bundle.deduce(img_seq, [len(img_paths)])
+Besides torch, numpy and PIL, only the parse states of syntax.parser are imported, so the parser runs on exactly
+the features it is trained on. The ground-truth semantics are imported from data/domain.py, and DreamCoder is only
+imported when a learned semantics is applied outside its exported table.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from syntax.parser import BatchParse
+
+EXEC_ERRORS = (IndexError, TypeError, ZeroDivisionError, ValueError, RecursionError)
+ERROR = 'error' # output of a tabulated semantics on which the program raised
+
+def load_image(img_file):
+    # same preprocessing as utils.load_image, with PIL only
+    img = Image.open(img_file).convert('L')
+    img = ImageOps.invert(img)
+    w, h = img.size
+    img = ImageOps.expand(img, ((60-w)//2, (60-h)//2, 60-w-(60-w)//2, 60-h-(60-h)//2), 0)
+    img = img.resize((40, 40), Image.BILINEAR)
+    img = img.crop((4, 4, 36, 36))
+    return torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.).unsqueeze(0)
+
+class TableSemantics(object):
+    """ A semantics exported as its outputs on [0, table_max]^arity, with the program as a fallback.
+        The inputs on which the program raised are exported as ERROR, and raise again here.
+    """
+    def __init__(self, entry):
+        self.arity = entry['arity']
+        self.table_max = entry['table_max']
+        self.table = entry['table']
+        self.source = entry['program']
+        self.fn = None
+
+    def __call__(self, *inputs):
+        if len(inputs) != self.arity or None in inputs:
+            raise TypeError
+        index = 0
+        for x in inputs:
+            if not 0 <= x <= self.table_max:
+                return self.fallback(*inputs)
+            index = index * (self.table_max + 1) + x
+        y = self.table[index]
+        if y == ERROR:
+            raise ValueError
+        return y
+
+    def fallback(self, *inputs):
+        if self.fn is None:
+            sys.path.insert(0, "./semantics/dreamcoder")
+            from dreamcoder.domains.hint.hintPrimitives import McCarthyPrimitives
+            from dreamcoder.program import Program
+            McCarthyPrimitives()
+            self.fn = Program.parse(self.source).evaluate([])
+        fn = self.fn
+        for x in inputs:
+            fn = fn(x)
+        return fn
+
+def load_semantics(entry):
+    if entry is None:
+        return None
+    if 'builtin' in entry:
+        from data.domain import SYM2PROG
+        return SYM2PROG[entry['builtin']]
+    return TableSemantics(entry)
+
+def execute(semantics, sentence, head):
+    # result of the expression, None if it fails, as in jointer.AST
+    children = [[] for _ in sentence]
+    root = -1
+    for k, h in enumerate(head):
+        if h == -1:
+            root = k
+        else:
+            children[h].append(k)
+
+    def run(k):
+        smt = semantics[sentence[k]]
+        args = [run(c) for c in children[k]]
+        args = [x for x in args if x is not None]
+        if smt is None: # no program, as concept.Semantics: None without inputs, the expression fails otherwise
+            if args:
+                raise TypeError
+            return None
+        r = smt(*args)
+        return None if r is None or r > sys.maxsize else r
+
+    try:
+        return run(root)
+    except EXEC_ERRORS:
+        return None
+
+class Bundle(object):
+    def __init__(self, bundle_dir, device='cpu'):
+        self.device = torch.device(device)
+        meta = json.load(open(os.path.join(bundle_dir, 'bundle.json')))
+        self.symbols = meta['symbols']
+        self.null = meta['null']
+        self.perception = torch.jit.load(os.path.join(bundle_dir, 'perception.pt'), map_location=self.device)
+        self.parser = torch.jit.load(os.path.join(bundle_dir, 'parser.pt'), map_location=self.device)
+        self.perception.eval()
+        self.parser.eval()
+        self.semantics = [load_semantics(x) for x in meta['semantics']]
+
+    def parse(self, sentences):
+        # greedy decoding as syntax.Parser.parse_batch in eval mode
+        if len(sentences) == 0:
+            return []
+        batch = BatchParse(sentences, self.null, self.device)
+        rows = torch.arange(len(sentences), device=self.device)
+        while len(rows) > 0:
+            logits = self.parser(batch.features(rows)).masked_fill(~batch.legal(rows), float('-inf'))
+            batch.step(rows, torch.argmax(logits, -1))
+            rows = rows[~batch.finish[rows]]
+        head = batch.head.cpu().numpy()
+        return [head[i, :l].tolist() for i, l in enumerate(batch.lengths)]
+
+    def deduce(self, img_seq, lengths):
+        with torch.no_grad():
+            symbols = torch.argmax(self.perception(img_seq.to(self.device)), -1).cpu().numpy()
+        sentences = [x.tolist() for x in np.split(symbols, np.cumsum(lengths)[:-1])]
+        with torch.no_grad():
+            heads = self.parse(sentences)
+        results = [execute(self.semantics, s, h) for s, h in zip(sentences, heads)]
+        return results, sentences, heads
+
+    def sentence_str(self, sentence):
+        return ''.join([self.symbols[s] for s in sentence])
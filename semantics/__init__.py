@@ -1,9 +1,11 @@
 from utils import SYMBOLS, SYM2PROG
-from .semantics import DreamCoder, Semantics
+from .concept import Semantics
 
 class SemanticsGT():
     def __init__(self):
         self.semantics = [Semantics(i, SYM2PROG[s]) for i, s in enumerate(SYMBOLS)]
+        self.version = 0
+        self.program_version = 0
 
     def __call__(self):
         return self.semantics
@@ -19,5 +21,7 @@ def build(config=None):
     if config.semantics:
         model = SemanticsGT()
     else:
-        model = DreamCoder()
+        # the DreamCoder stack is only imported for the learned semantics
+        from .semantics import DreamCoder
+        model = DreamCoder(enumeration_scheduler=getattr(config, 'enumeration_scheduler', False))
     return model
\ No newline at end of file
@@ -0,0 +1,270 @@
+"""
+The semantics of a single concept and its examples. Only the tasks made for DreamCoder need the
+DreamCoder stack, which is imported by make_task, so the ground-truth semantics can be used without it.
+"""
+import random
+from collections import Counter
+from itertools import product
+import numpy as np
+
+# fixed probe inputs used to fingerprint the behavior of a program, one set per arity
+PROBE_VALUES = list(range(8))
+PROBE_ERRORS = (IndexError, TypeError, ZeroDivisionError, ValueError, RecursionError)
+_fingerprints = {} # program string -> fingerprint, shared by all wrappers of the same program
+MAX_FINGERPRINTS = int(1e5) # the cache is cleared when it grows beyond this
+
+def probe_inputs(arity):
+    return list(product(PROBE_VALUES, repeat=arity))
+
+class ProgramWrapper(object):
+    def __init__(self, prog):
+        try:
+            self.fn = prog.evaluate([])
+        except RecursionError as e:
+            self.fn = None
+        self.prog = prog
+        self.arity = len(prog.infer().functionArguments())
+        self._name = None
+        self.cache = {} # used for fast computation
+    
+    def __call__(self, *inputs):
+        if len(inputs) != self.arity or None in inputs:
+            raise TypeError
+        if inputs in self.cache:
+            return self.cache[inputs]
+        fn = self.fn
+        for x in inputs:
+            fn = fn(x)
+        self.cache[inputs] = fn
+        return fn
+
+    @property
+    def fingerprint(self):
+        # hash of the outputs on the probe inputs of its arity, two programs with the same fingerprint
+        # are considered functionally equivalent. None if the program cannot be evaluated or fails on every probe,
+        # since such programs tell nothing about their behavior and must not be merged.
+        key = str(self.prog)
+        if key in _fingerprints:
+            return _fingerprints[key]
+        if self.fn is None:
+            fp = None
+        else:
+            outputs = []
+            for xs in probe_inputs(self.arity):
+                try:
+                    y = self(*xs)
+                except PROBE_ERRORS:
+                    y = None
+                outputs.append(y)
+            fp = hash((self.arity, tuple(outputs))) if any(y is not None for y in outputs) else None
+        if len(_fingerprints) >= MAX_FINGERPRINTS:
+            _fingerprints.clear()
+        _fingerprints[key] = fp
+        return fp
+
+    def __eq__(self, prog): # only used for removing equivalent semantics
+        if not isinstance(prog, ProgramWrapper) or self.arity != prog.arity:
+            return False
+        if self.fingerprint is None or prog.fingerprint is None:
+            return False
+        return self.fingerprint == prog.fingerprint
+
+    def __hash__(self):
+        return hash(str(self.prog))
+
+    def __str__(self):
+        return "%s %s"%(self.name, self.prog)
+
+    @property
+    def name(self):
+        if self._name is not None: return self._name
+        if isinstance(self.fn, int):
+            self._name = str(self.fn)
+        else:
+            self._name = "fn"
+            pass # TODO: assign name based on the function
+        return self._name
+
+    def evaluate(self, examples, store_y=True): 
+        ys = []
+        for exp in examples:
+            try:
+                y = self(*exp)
+            except (TypeError, RecursionError) as e:
+                y = None
+            ys.append(y)
+        return ys
+
+def compute_likelihood(program=None, examples=None):
+    if examples is None:
+        return 0., None
+    elif program is None:
+        res = [True if len(xs) == 0 and y is None else False for xs, y in examples ]
+        return np.mean(res), np.array(res)
+    else:
+        pred = program.evaluate([e[0] for e in examples], store_y=False)
+        gt = np.array([e[1] for e in examples])
+        res = pred == gt
+        return np.mean(res), np.array(res)
+
+class ExampleSet(object):
+    """ A multiset of examples (xs, y) -> count, with running histograms of the arity and None outputs. """
+    def __init__(self):
+        self.counts = Counter()
+        self.arity_counts = Counter() # (arity, y is None) -> count
+        self.n_none = 0
+        self.total = 0
+
+    def add(self, xs, y, count=1):
+        self.counts[(xs, y)] += count
+        self.arity_counts[(len(xs), y is None)] += count
+        self.n_none += count if y is None else 0
+        self.total += count
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def n_unique(self):
+        return len(self.counts)
+
+    def most_common_arity(self, with_none=True):
+        arity_counts = Counter()
+        for (arity, is_none), c in self.arity_counts.items():
+            if with_none or not is_none:
+                arity_counts[arity] += c
+        return arity_counts.most_common(1)[0][0]
+
+    def select(self, fn):
+        subset = ExampleSet()
+        for (xs, y), c in self.counts.items():
+            if fn((xs, y)):
+                subset.add(xs, y, c)
+        return subset
+
+    def sample(self, k):
+        # sample k examples with replacement, in proportion to their counts
+        if k <= 0 or self.total == 0:
+            return []
+        return random.choices(list(self.counts.keys()), weights=list(self.counts.values()), k=k)
+
+    def tolist(self):
+        return [e for e, c in self.counts.items() for _ in range(c)]
+
+class Semantics(object):
+    def __init__(self, idx, program=None, fewshot=False, learnable=True):
+        self.idx = idx
+        self.examples = ExampleSet()
+        self.new_examples = ExampleSet() # collected from the abduced samples since the last update
+        self.correct = {} # example -> whether the current program is correct on it
+        self.program = program
+        self.arity = None
+        self.solved = False
+        self.likelihood = 0.
+        self.fewshot = fewshot
+        self.learnable = learnable
+
+    def evaluate_examples(self, program, correct=None):
+        # correctness of the program on the unique examples, only the examples not in `correct` are evaluated
+        correct = {} if correct is None else correct
+        new = [e for e in self.examples if e not in correct]
+        if new:
+            correct.update(zip(new, compute_likelihood(program, new)[1]))
+        likelihood = sum([c for e, c in self.examples.counts.items() if correct[e]]) / max(len(self.examples), 1)
+        return likelihood, correct
+
+    def update_examples(self, examples=None):
+        if examples is None:
+            examples, self.new_examples = self.new_examples, ExampleSet()
+        if len(examples) < 10 and not self.fewshot:
+            self.clear()
+            return
+
+        with_none = True
+        if examples.n_none > 0:
+            if examples.n_none / len(examples) >= 0.8:
+                self.program = None
+                self.correct = {}
+            else:
+                with_none = False
+        
+        arity = examples.most_common_arity(with_none)
+        examples = examples.select(lambda x: len(x[0]) == arity and (with_none or x[1] is not None))
+
+        self.arity = arity
+        self.examples = examples
+        self.likelihood, self.correct = self.evaluate_examples(self.program, self.correct)
+        self.check_solved()
+
+    def update_program(self, entry):
+        program = ProgramWrapper(entry.program)
+        likelihood, correct = self.evaluate_examples(program)
+        if (likelihood > self.likelihood) or \
+            (likelihood == self.likelihood and len(str(program)) < len(str(self.program))):
+            self.program = program
+            self.correct = correct
+            self.likelihood = likelihood
+            self.check_solved()
+    
+    def check_solved(self):
+        if self.arity == 0 and self.likelihood > 0. and self.program is not None:
+            self.solved = True
+        elif self.arity > 0 and self.likelihood >= 0.9 and self.examples.n_unique() >= 80 and '#' not in str(self.program): # for + -
+            self.solved = True
+        elif self.arity > 0 and self.likelihood >= 0.95 and self.examples.n_unique() >= 80 and '#' in str(self.program):
+            self.solved = True
+        elif self.fewshot and self.likelihood >= 0.95 and self.examples.n_unique() >= 10:
+            self.solved = True
+        else:
+            self.solved = False
+
+    def __call__(self, *inputs):
+        if self.program is None and len(inputs) == 0:
+            return None
+        return self.program(*inputs)
+
+    def make_task(self):
+        min_examples = 30 if self.arity is not None and self.arity > 0 else 10
+        min_examples = min_examples if not self.fewshot else 0
+        max_examples = 100
+        examples = self.examples
+        if len(examples) < min_examples or self.solved or examples.n_none > 0:
+            return None
+        from dreamcoder.task import Task
+        from dreamcoder.type import arrow, tint
+        task_type = arrow(*([tint]*(self.arity + 1)))
+        if len(examples) > max_examples:
+            wrong_examples = examples.select(lambda e: not self.correct[e])
+            right_examples = examples.select(lambda e: self.correct[e])
+            if len(wrong_examples) > max_examples:
+                wrong_examples = wrong_examples.sample(max_examples)
+            else:
+                wrong_examples = wrong_examples.tolist()
+            examples = wrong_examples + right_examples.sample(max_examples - len(wrong_examples))
+            random.shuffle(examples)
+        else:
+            examples = examples.tolist()
+        return Task(str(self.idx), task_type, examples)
+
+    def clear(self):
+        self.examples = ExampleSet()
+        self.correct = {}
+        self.program = None
+        self.arity = None
+        self.solved = False
+        self.likelihood = 0.
+    
+    def save(self):
+        model = {'idx': self.idx, 'solved': self.solved, 'likelihood': self.likelihood, 'arity': self.arity}
+        model['program'] = None if self.program is None else self.program.prog
+        return model
+
+    def load(self, model):
+        self.idx = model['idx']
+        self.solved = model['solved']
+        self.likelihood = model['likelihood']
+        self.arity = model['arity']
+        self.program = None if model['program'] is None else ProgramWrapper(model['program'])
+        self.correct = {}
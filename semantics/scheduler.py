@@ -0,0 +1,82 @@
+import math
+import multiprocessing as mp
+from queue import Empty
+from time import time
+
+from dreamcoder.enumeration import multicoreEnumeration
+from dreamcoder.frontier import Frontier
+from dreamcoder.utilities import numberOfCPUs
+
+def task_difficulty(smt, task):
+    # harder tasks: more arguments, lower likelihood of the current program, more examples to fit
+    arity = smt.arity if smt.arity is not None else 0
+    return (1 + arity) * (1. - smt.likelihood + 0.05) * math.log2(2 + len(task.examples))
+
+def _enumerate(queue, grammar, task, timeout, kwargs):
+    frontiers, _ = multicoreEnumeration(grammar, [task], enumerationTimeout=timeout, CPUs=1, verbose=False, **kwargs)
+    queue.put((task.name, frontiers[0]))
+
+class EnumerationScheduler(object):
+    """ Run the enumeration of each symbol as a separate job in a pool of processes.
+        The CPU budget is shared among the tasks in proportion to their difficulty. Each task is enumerated
+        in slices of growing length, and it stops as soon as its semantics is solved or its budget is used up.
+        Every slice enumerates again from scratch with a longer timeout, and no recognition model is trained,
+        so it is opt-in (DreamCoder(enumeration_scheduler=True), --enumeration-scheduler in train.py).
+    """
+    def __init__(self, CPUs=None, min_slice=5, solver='ocaml', maximumFrontier=5, evaluationTimeout=None):
+        self.CPUs = CPUs or numberOfCPUs()
+        self.min_slice = min_slice
+        self.maximumFrontier = maximumFrontier
+        self.enum_args = {'solver': solver, 'maximumFrontier': maximumFrontier, 'evaluationTimeout': evaluationTimeout}
+
+    def allocate(self, semantics, tasks, wall_time):
+        # budget (CPU-seconds) for each task, no task can use more than the wall time
+        weights = {t.name: task_difficulty(semantics[int(t.name)], t) for t in tasks}
+        total = wall_time * min(self.CPUs, len(tasks))
+        norm = sum(weights.values())
+        return {k: min(wall_time, max(self.min_slice, total * w / norm)) for k, w in weights.items()}
+
+    def run(self, grammar, tasks, semantics, wall_time, frontiers=None):
+        budgets = self.allocate(semantics, tasks, wall_time)
+        used = {t.name: 0. for t in tasks}
+        results = {t.name: Frontier([], task=t) for t in tasks}
+        if frontiers is not None:
+            results.update({t.name: f for t, f in frontiers.items() if t.name in results})
+
+        pending = sorted(tasks, key=lambda t: -budgets[t.name]) # hardest first
+        running = {} # task name -> (process, task, time slice)
+        queue = mp.Queue()
+        st = time()
+        while pending or running:
+            while pending and len(running) < self.CPUs:
+                task = pending.pop(0)
+                remain = budgets[task.name] - used[task.name]
+                time_slice = min(remain, max(self.min_slice, used[task.name])) # double the used time in each slice
+                p = mp.Process(target=_enumerate, args=(queue, grammar, task, time_slice, self.enum_args))
+                p.start()
+                running[task.name] = (p, task, time_slice)
+
+            # drop the jobs that crashed without returning a result, so that their CPUs are given to pending jobs
+            for name in [k for k, v in running.items() if not v[0].is_alive() and v[0].exitcode != 0]:
+                print("Enumeration for Symbol-%02d failed."%int(name))
+                running.pop(name)
+            try:
+                name, frontier = queue.get(timeout=1)
+            except Empty:
+                continue
+
+            p, task, time_slice = running.pop(name)
+            p.join()
+            used[name] += time_slice
+            frontier.task = task
+            results[name] = results[name].combine(frontier).topK(self.maximumFrontier)
+
+            smt = semantics[int(name)]
+            if results[name].entries:
+                smt.update_program(results[name].bestPosterior)
+            if not smt.solved and used[name] < budgets[name]:
+                pending.append(task)
+
+        n_solved = len([t for t in tasks if semantics[int(t.name)].solved])
+        print("Enumerate %d tasks with %d CPUs, solve %d, take %d sec."%(len(tasks), self.CPUs, n_solved, time()-st))
+        return list(results.values())
@@ -4,10 +4,12 @@ sys.path.insert(0, "./semantics/dreamcoder")
 
 import random
 from collections import defaultdict, Counter 
+from itertools import product
 import json
 import math
 import os
 import datetime
+import hashlib
 import numpy as np
 import torch
 
@@ -24,169 +26,62 @@ from dreamcoder.domains.hint.hintPrimitives import McCarthyPrimitives
 from dreamcoder.domains.hint.main import main, list_options, LearnedFeatureExtractor
 
 from utils import SYMBOLS
+from .scheduler import EnumerationScheduler
+from .concept import ProgramWrapper, compute_likelihood, ExampleSet, Semantics
 
-class ProgramWrapper(object):
-    def __init__(self, prog):
-        try:
-            self.fn = prog.evaluate([])
-        except RecursionError as e:
-            self.fn = None
-        self.prog = prog
-        self.arity = len(prog.infer().functionArguments())
-        self._name = None
-        self.cache = {} # used for fast computation
-    
-    def __call__(self, *inputs):
-        if len(inputs) != self.arity or None in inputs:
-            raise TypeError
-        if inputs in self.cache:
-            return self.cache[inputs]
-        fn = self.fn
-        for x in inputs:
-            fn = fn(x)
-        self.cache[inputs] = fn
-        return fn
-
-    def __eq__(self, prog): # only used for removing equivalent semantics
-        if self.arity != prog.arity:
-            return False
-        if isinstance(self.fn, int) and isinstance(prog.fn, int):
-            return self.fn == prog.fn
-        # if self.y is not None and prog.y is not None:
-        #     assert len(self.y) == len(prog.y) # the program should be evaluated on same examples
-        #     return np.mean(self.y[self.y!=None] == prog.y[self.y!=None]) > 0.95
-        # return self.prog == prog.prog
-        return False
-
-    def __str__(self):
-        return "%s %s"%(self.name, self.prog)
-
-    @property
-    def name(self):
-        if self._name is not None: return self._name
-        if isinstance(self.fn, int):
-            self._name = str(self.fn)
-        else:
-            self._name = "fn"
-            pass # TODO: assign name based on the function
-        return self._name
-
-    def evaluate(self, examples, store_y=True): 
-        ys = []
-        for exp in examples:
-            try:
-                y = self(*exp)
-            except (TypeError, RecursionError) as e:
-                y = None
-            ys.append(y)
-        return ys
-
-def compute_likelihood(program=None, examples=None):
-    if examples is None:
-        return 0., None
-    elif program is None:
-        res = [True if len(xs) == 0 and y is None else False for xs, y in examples ]
-        return np.mean(res), np.array(res)
-    else:
-        pred = program.evaluate([e[0] for e in examples], store_y=False)
-        gt = np.array([e[1] for e in examples])
-        res = pred == gt
-        return np.mean(res), np.array(res)
-
-class Semantics(object):
-    def __init__(self, idx, program=None, fewshot=False, learnable=True):
-        self.idx = idx
-        self.examples = []
-        self.program = program
-        self.arity = None
-        self.solved = False
-        self.likelihood = 0.
-        self.fewshot = fewshot
-        self.learnable = learnable
-
-    def update_examples(self, examples):
-        if len(examples) < 10 and not self.fewshot:
-            self.clear()
-            return
+def grammar_key(grammar):
+    return hashlib.md5(str(grammar).encode()).hexdigest()
 
-        if None in [x[1] for x in examples]:
-            counts = Counter([x[1] for x in examples])
-            if counts[None] / len(examples) >= 0.8:
-                self.program = None
-            else:
-                examples = [x for x in examples if x[1] is not None]
-        
-        arity = Counter([len(x[0]) for x in examples]).most_common(1)[0][0]
-        examples = [x[:2] for x in examples if len(x[0]) == arity] 
-
-        self.arity = arity
-        self.examples = examples
-        self.likelihood, self.res = compute_likelihood(self.program, self.examples)
-        self.check_solved()
-
-    def update_program(self, entry):
-        program = ProgramWrapper(entry.program)
-        likelihood = compute_likelihood(program, self.examples)[0]
-        if (likelihood > self.likelihood) or \
-            (likelihood == self.likelihood and len(str(program)) < len(str(self.program))):
-            self.program = program
-            self.likelihood = likelihood
-            self.check_solved()
-    
-    def check_solved(self):
-        if self.arity == 0 and self.likelihood > 0. and self.program is not None:
-            self.solved = True
-        elif self.arity > 0 and self.likelihood >= 0.9 and len(set(self.examples)) >= 80 and '#' not in str(self.program): # for + -
-            self.solved = True
-        elif self.arity > 0 and self.likelihood >= 0.95 and len(set(self.examples)) >= 80 and '#' in str(self.program):
-            self.solved = True
-        elif self.fewshot and self.likelihood >= 0.95 and len(set(self.examples)) >= 10:
-            self.solved = True
-        else:
-            self.solved = False
-
-    def __call__(self, *inputs):
-        if self.program is None and len(inputs) == 0:
-            return None
-        return self.program(*inputs)
-
-    def make_task(self):
-        min_examples = 30 if self.arity is not None and self.arity > 0 else 10
-        min_examples = min_examples if not self.fewshot else 0
-        max_examples = 100
-        examples = self.examples
-        if len(examples) < min_examples or self.solved or None in [x[1] for x in examples]:
+class FrontierStore(object):
+    """ Frontiers and helmholtz frontiers found by the enumeration, keyed by (grammar hash, task request type).
+        It is saved with the checkpoint, so that the enumeration work is not lost when resuming the training.
+    """
+    def __init__(self):
+        self.frontiers = {} # (grammar, request) -> {task name: frontier}
+        self.helmholtz = {} # (grammar, request) -> [frontier]
+
+    def invalidate(self, grammar):
+        # drop all the frontiers that are not found under the given grammar
+        key = grammar_key(grammar)
+        self.frontiers = {k: v for k, v in self.frontiers.items() if k[0] == key}
+        self.helmholtz = {k: v for k, v in self.helmholtz.items() if k[0] == key}
+
+    def put_frontiers(self, grammar, frontiers):
+        key = grammar_key(grammar)
+        for frontier in frontiers:
+            task = frontier.task
+            self.frontiers.setdefault((key, str(task.request)), {})[task.name] = frontier
+
+    def get_frontiers(self, grammar, tasks):
+        key = grammar_key(grammar)
+        frontiers = [self.frontiers.get((key, str(t.request)), {}).get(t.name) for t in tasks]
+        frontiers = [f for f in frontiers if f is not None]
+        return frontiers if frontiers else None
+
+    def put_helmholtz(self, grammar, frontiers):
+        key = grammar_key(grammar)
+        groups = defaultdict(list)
+        for frontier in frontiers:
+            groups[(key, str(frontier.task.request))].append(frontier)
+        self.helmholtz.update(groups)
+
+    def get_helmholtz(self, grammar, requests):
+        key = grammar_key(grammar)
+        keys = [(key, str(r)) for r in requests]
+        if not all(k in self.helmholtz for k in keys):
             return None
-        task_type = arrow(*([tint]*(self.arity + 1)))
-        if len(examples) > max_examples:
-            wrong_examples = [e for e, r in zip(examples, self.res) if not r]
-            right_examples = [e for e, r in zip(examples, self.res) if r]
-            right_examples = random.choices(right_examples, k=max_examples-len(wrong_examples))
-            examples = wrong_examples + right_examples
-            examples = random.sample(examples, k=max_examples)
-        return Task(str(self.idx), task_type, examples)
-
-    def clear(self):
-        self.examples = []
-        self.program = None
-        self.arity = None
-        self.solved = False
-        self.likelihood = 0.
-    
+        frontiers = [f for k in keys for f in self.helmholtz[k]]
+        return lambda: frontiers
+
     def save(self):
-        model = {'idx': self.idx, 'solved': self.solved, 'likelihood': self.likelihood, 'arity': self.arity}
-        model['program'] = None if self.program is None else self.program.prog
-        return model
+        return {'frontiers': self.frontiers, 'helmholtz': self.helmholtz}
 
     def load(self, model):
-        self.idx = model['idx']
-        self.solved = model['solved']
-        self.likelihood = model['likelihood']
-        self.arity = model['arity']
-        self.program = None if model['program'] is None else ProgramWrapper(model['program'])
+        self.frontiers = model['frontiers']
+        self.helmholtz = model['helmholtz']
 
 class DreamCoder(object):
-    def __init__(self):
+    def __init__(self, enumeration_scheduler=False):
         args = commandlineArguments(
             enumerationTimeout=200, activation='tanh', iterations=1, recognitionTimeout=3600,
             a=3, maximumFrontier=5, topK=2, pseudoCounts=30.0,
@@ -227,22 +122,41 @@ class DreamCoder(object):
         self.semantics = [Semantics(i) for i in range(len(SYMBOLS))] 
         self.allFrontiers = None
         self.helmholtzFrontiers = None
+        self.frontier_store = FrontierStore()
+        self.version = 0 # increased whenever the saved state changes, i.e. in every learning (read by the checkpointer)
+        self.program_version = 0 # increased only when the programs change, so the deductions stay valid otherwise
+        # by default, a single explorationCompression (with the recognition model and the helmholtz frontiers)
+        # runs over all tasks; with enumeration_scheduler, each symbol is enumerated in its own process with a
+        # difficulty-based CPU budget instead
+        self.scheduler = None
+        if enumeration_scheduler:
+            self.scheduler = EnumerationScheduler(solver=args['solver'], maximumFrontier=args['maximumFrontier'],
+                                                  evaluationTimeout=args['evaluationTimeout'])
 
     def __call__(self):
         return self.semantics
 
     def save(self):
-        model = [smt.save() for smt in self.semantics]
+        model = {'semantics': [smt.save() for smt in self.semantics]}
+        model['frontiers'] = self.frontier_store.save()
         return model
 
     def load(self, model):
         if model is None:
             return
-        assert len(self.semantics) == len(model)
+        if isinstance(model, list): # old checkpoints only store the semantics
+            model = {'semantics': model}
+        assert len(self.semantics) == len(model['semantics'])
         for i in range(len(self.semantics)):
-            self.semantics[i].load(model[i])
+            self.semantics[i].load(model['semantics'][i])
+        if 'frontiers' in model:
+            self.frontier_store.load(model['frontiers'])
+        self.version += 1
+        self.program_version += 1
     
     def extend(self, n):
+        self.version += 1
+        self.program_version += 1
         for smt in self.semantics:
             smt.learnable = False
         idx = len(SYMBOLS) - 1
@@ -273,13 +187,32 @@ class DreamCoder(object):
             allFrontiers[task] = frontier
         self.allFrontiers = allFrontiers
 
-    def learn(self, dataset):
+    def add_example(self, symbol, xs, y):
+        self.semantics[symbol].new_examples.add(xs, y)
+
+    def _signature(self):
+        return [(str(smt.program), smt.solved, smt.arity) for smt in self.semantics]
+
+    def learn(self, dataset=None):
+        # the examples are collected incrementally by `add_example`, `dataset` is a list of examples per symbol
+        if dataset is not None:
+            for symbol, exps in enumerate(dataset):
+                for xs, y in exps:
+                    self.add_example(symbol, xs, y)
+        signature = self._signature()
+        self._learn()
+        self.version += 1 # the frontiers and the likelihoods are updated even if no program has changed
+        if self._signature() != signature:
+            self.program_version += 1
+
+    def _learn(self):
         tasks = []
         max_arity = 0
-        for smt, exps in zip(self.semantics, dataset):
+        for smt in self.semantics:
+            examples, smt.new_examples = smt.new_examples, ExampleSet()
             if not smt.learnable:
                 continue
-            smt.update_examples(exps)
+            smt.update_examples(examples)
             t = smt.make_task()
             if t is not None:
                 tasks.append(t)
@@ -294,14 +227,41 @@ class DreamCoder(object):
         self._print_tasks(tasks)
         self.update_grammar()
         print(self.grammar)
-        # print(self.allFrontiers)
+        requests = {t.request for t in tasks}
+        if self.allFrontiers is None:
+            self.allFrontiers = self.frontier_store.get_frontiers(self.grammar, tasks)
+        if self.helmholtzFrontiers is None:
+            self.helmholtzFrontiers = self.frontier_store.get_helmholtz(self.grammar, requests)
         self.rescore_frontiers(tasks)
-        # if self.allFrontiers is not None:
-        #     print(self.allFrontiers.values())
 
+        # the stored frontiers may already solve some tasks under the new examples, skip enumeration for them
+        if self.allFrontiers is not None:
+            for frontier in self.allFrontiers.values():
+                if frontier.entries:
+                    self.semantics[int(frontier.task.name)].update_program(frontier.bestPosterior)
+            tasks = [t for t in tasks if not self.semantics[int(t.name)].solved]
+            self.allFrontiers = {t: f for t, f in self.allFrontiers.items() if t in tasks}
+            if len(tasks) == 0:
+                print("All tasks are solved by the stored frontiers.")
+                self.allFrontiers = None # will be reloaded from the store in next learning
+                self._removeEquivalentSemantics()
+                self._print_semantics()
+                return
+            requests = {t.request for t in tasks}
+
+        if self.scheduler is not None:
+            wall_time = self.train_args['enumerationTimeout']
+            self.allFrontiers = self.scheduler.run(self.grammar, tasks, self.semantics, wall_time, frontiers=self.allFrontiers)
+            self.frontier_store.put_frontiers(self.grammar, self.allFrontiers)
+        else:
+            self._explorationCompression(tasks, requests)
+        self._removeEquivalentSemantics()
+        self._print_semantics()
+        # self.grammar = result.grammars[-1]
+
+    def _explorationCompression(self, tasks, requests):
         if self.helmholtzFrontiers is not None:
             requests_old ={x.task.request for x in self.helmholtzFrontiers()}
-            requests = {t.request for t in tasks}
             # if new requests, discard old helmholtz frontiers
             if requests != requests_old:
                 self.helmholtzFrontiers = None
@@ -309,30 +269,38 @@ class DreamCoder(object):
         result = explorationCompression(self.grammar, tasks, allFrontiers=self.allFrontiers, helmholtzFrontiers=self.helmholtzFrontiers, **self.train_args)
         self.allFrontiers = list(result.allFrontiers.values())
         self.helmholtzFrontiers = result.helmholtzFrontiers
+        self.frontier_store.put_frontiers(self.grammar, self.allFrontiers)
+        if self.helmholtzFrontiers is not None:
+            self.frontier_store.put_helmholtz(self.grammar, self.helmholtzFrontiers())
 
         for frontier in result.taskSolutions.values():
             if not frontier.entries: continue
             symbol_idx = int(frontier.task.name)
             # print(frontier)
             self.semantics[symbol_idx].update_program(frontier.bestPosterior)
-        # examples = [xs for t in tasks for xs, y in t.examples]
-        # self._removeEquivalentSemantics(examples)
-        self._removeEquivalentSemantics()
-        self._print_semantics()
-        # self.grammar = result.grammars[-1]
 
     def update_grammar(self):
-        programs = [Invented(smt.program.prog) for smt in self.semantics 
+        candidates = [smt.program for smt in self.semantics 
             if smt.learnable and smt.solved and smt.program is not None and smt.program.arity > 0 and '#' not in str(smt.program)]
             # if '#' in the program, the program uses a invented primitive, it is very likely to have a high computation cost.
             # Therefore we don't add this program into primitives, since it might slow the enumeration a lot.
             # it might be resolved by increasing the enumeration time
+        # skip inventions that behave the same as an existing invented primitive or an earlier candidate
+        seen = {ProgramWrapper(p).fingerprint for p in self.primitives if isinstance(p, Invented)}
+        programs = []
+        for prog in candidates:
+            fp = prog.fingerprint
+            if fp is not None and fp in seen:
+                continue
+            seen.add(fp)
+            programs.append(Invented(prog.prog))
         new_grammar = Grammar.uniform(self.primitives + programs)
         # self.train_args['enumerationTimeout'] += 100 * len(programs)
         if new_grammar != self.grammar:
             self.grammar = new_grammar
             self.helmholtzFrontiers = None
             self.allFrontiers = None
+            self.frontier_store.invalidate(new_grammar)
             print("Update grammar with invented programs and set frontiers to none.")
         
 
@@ -347,24 +315,18 @@ class DreamCoder(object):
 
         json.dump([t.examples for t in tasks], open('outputs/tasks.json', 'w'))
 
-    def _removeEquivalentSemantics(self, examples=None):
-        if examples is not None:
-            examples = list(set(examples))
-            for smt in self.semantics:
-                if smt.program is not None:
-                    smt.program.evaluate(examples)
-        
-        for i in range(len(self.semantics) - 1):
-            smt_i = self.semantics[i]
-            if smt_i.program is None:
+    def _removeEquivalentSemantics(self):
+        # bucket the programs by their behavioral fingerprint, and only keep the symbol with most examples in each bucket
+        buckets = defaultdict(list)
+        for smt in self.semantics:
+            if smt.program is None or smt.program.fingerprint is None:
+                continue
+            buckets[smt.program.fingerprint].append(smt)
+
+        for smts in buckets.values():
+            if len(smts) == 1:
                 continue
-            for j in range(i+1, len(self.semantics)):
-                smt_j = self.semantics[j]
-                if smt_j.program is None:
-                    continue
-                if smt_i.program == smt_j.program:
-                    if len(smt_i.examples) >= len(smt_j.examples):
-                        smt_j.clear()
-                    else:
-                        smt_i.clear()
-                        break
+            keep = max(smts, key=lambda x: len(x.examples)) # ties are resolved by the smallest index
+            for smt in smts:
+                if smt is not keep:
+                    smt.clear()
@@ -0,0 +1,199 @@
+"""
+Serve a trained model on CPU, over HTTP on a TCP port or a Unix socket.
+    python serve.py --resume outputs/model_100.p --port 8000
+    curl -X POST localhost:8000/predict -d '{"img_paths": ["1/1_1.png", "+/+_1.png", "2/2_1.png"]}'
+Images can be given as paths (relative to IMG_DIR) with "img_paths", or base64-encoded files with "images".
+Concurrent requests are grouped into micro-batches, and each micro-batch is deduced with a single call.
+GET /metrics returns the histograms of latency and batch size.
+"""
+import os
+os.environ['CUDA_VISIBLE_DEVICES'] = '' # serving is CPU-only
+
+import argparse
+import asyncio
+import base64
+import bisect
+import io
+import json
+import sys
+import time
+
+import torch
+from utils import ID2SYM, IMG_DIR, load_image, add_inference_args, load_inference_model
+
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000] # ms
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+def parse_args():
+    parser = argparse.ArgumentParser('Serve a HINT model')
+    add_inference_args(parser)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default=None, help='serve on this unix socket instead of the tcp port')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='max number of requests in a micro-batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5., help='max time to wait for a micro-batch to fill')
+    parser.add_argument('--threads', type=int, default=None, help='number of threads used by torch')
+    args = parser.parse_args()
+    return args
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, x):
+        self.counts[bisect.bisect_left(self.buckets, x)] += 1
+        self.count += 1
+        self.sum += x
+
+    def state(self):
+        keys = ['<=%g'%b for b in self.buckets] + ['>%g'%self.buckets[-1]]
+        return {'count': self.count, 'mean': self.sum / max(self.count, 1), 'buckets': dict(zip(keys, self.counts))}
+
+class MicroBatcher(object):
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = None
+        self.metrics = {
+            'latency_ms': Histogram(LATENCY_BUCKETS),
+            'queue_ms': Histogram(LATENCY_BUCKETS),
+            'deduce_ms': Histogram(LATENCY_BUCKETS),
+            'batch_size': Histogram(BATCH_BUCKETS),
+        }
+
+    async def submit(self, img_seq):
+        future = asyncio.get_event_loop().create_future()
+        st = time.time()
+        await self.queue.put((img_seq, future, st))
+        output = await future
+        self.metrics['latency_ms'].add(1000 * (time.time() - st))
+        return output
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            st = time.time()
+            for _, _, t in batch:
+                self.metrics['queue_ms'].add(1000 * (st - t))
+            self.metrics['batch_size'].add(len(batch))
+            try:
+                outputs = await loop.run_in_executor(None, self.deduce, [x[0] for x in batch])
+            except Exception as e:
+                outputs = [e] * len(batch)
+            self.metrics['deduce_ms'].add(1000 * (time.time() - st))
+
+            for (_, future, _), output in zip(batch, outputs):
+                if future.cancelled():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    def deduce(self, img_seqs):
+        sample = {'img_seq': torch.cat(img_seqs), 'len': [len(x) for x in img_seqs]}
+        with torch.no_grad():
+            results, sentences, heads = self.model.deduce(sample)
+        outputs = []
+        for res, sent, head in zip(results, sentences, heads):
+            outputs.append({'result': None if res is None else int(res),
+                            'sentence': ''.join(map(ID2SYM, sent)),
+                            'head': [int(h) for h in head]})
+        return outputs
+
+def read_images(request):
+    if 'img_paths' in request:
+        files = [p if os.path.isabs(p) else IMG_DIR + p for p in request['img_paths']]
+    elif 'images' in request:
+        files = [io.BytesIO(base64.b64decode(x)) for x in request['images']]
+    else:
+        raise ValueError('request must contain "img_paths" or "images"')
+    if len(files) == 0:
+        raise ValueError('empty expression')
+    return torch.stack([load_image(f) for f in files])
+
+class InferenceServer(object):
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, {k: v.state() for k, v in self.batcher.metrics.items()}
+        if method == 'POST' and path == '/predict':
+            try:
+                request = json.loads(body)
+                img_seq = await asyncio.get_event_loop().run_in_executor(None, read_images, request)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                return 400, {'error': str(e)}
+            try:
+                return 200, await self.batcher.submit(img_seq)
+            except Exception as e:
+                return 500, {'error': repr(e)}
+        return 404, {'error': 'unknown endpoint %s %s'%(method, path)}
+
+    async def handle(self, reader, writer):
+        # a minimal HTTP/1.1 handler, one request per connection
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode().split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await self.route(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {'error': 'malformed request: %s'%e}
+
+        data = json.dumps(response).encode()
+        header = 'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' \
+            %(status, HTTP_STATUS[status], len(data))
+        writer.write(header.encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, socket=None):
+        self.batcher.queue = asyncio.Queue()
+        asyncio.ensure_future(self.batcher.run())
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket)
+            print('Serving on unix socket %s'%socket)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            print('Serving on http://%s:%d'%(host, port))
+        async with server:
+            await server.serve_forever()
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = load_inference_model(args, 'cpu')
+    batcher = MicroBatcher(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    server = InferenceServer(batcher)
+    asyncio.get_event_loop().run_until_complete(server.serve(args.host, args.port, args.socket))
@@ -1,7 +1,7 @@
 from .parser import Parser, PartialParse
 
 def build(config):
-    model = Parser()
+    model = Parser(decode=getattr(config, 'parser_decode', 'greedy'))
     return model
 
 def convert_trans2dep(transitions):
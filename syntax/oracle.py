@@ -0,0 +1,89 @@
+"""
+Dynamic oracle of the arc-standard system: the loss of the best tree reachable from a configuration.
+
+From a configuration with the stack s_1 ... s_k and the buffer b_1 ... b_m, the reachable trees are the projective trees
+over the sequence of the unreduced tokens N = s_1 ... s_k b_1 ... b_m (the reduced tokens stay in the subtrees of their
+heads) where every token s_j below the top of the stack either has s_k in its subtree, or has no child and a head on
+its right: s_j can only get a child once all the tokens above it are in its subtree, and it is otherwise reduced by
+the token on its right when it is next to the top.
+The best of these trees is found with the algorithm of Eisner, restricted accordingly, and the loss is the number of
+tokens of N whose head is not the gold one.
+A transition is optimal if the loss of its arc plus the loss of the next configuration is the lowest.
+"""
+import numpy as np
+
+def min_loss(configs, heads, batch_size=2048):
+    """ The loss of the best tree reachable from each configuration.
+    @param configs (list): (stack, next) of each configuration, the buffer being next, next+1, ..., len(head)-1
+    @param heads (list): the gold heads of the sentence of each configuration, -1 for the root
+    @return loss (np.array): the least number of tokens of the stack and the buffer with a wrong head
+    """
+    loss = [np.zeros(0, dtype=np.float32)]
+    for st in range(0, len(configs), batch_size):
+        loss.append(_min_loss(configs[st:st+batch_size], heads[st:st+batch_size]))
+    return np.concatenate(loss)
+
+def _min_loss(configs, heads):
+    B = len(configs)
+    nodes = [list(stack) + list(range(next_, len(head))) for (stack, next_), head in zip(configs, heads)]
+    lengths = np.array([len(x) for x in nodes])
+    L = int(lengths.max())
+    N = np.full((B, L), -2, dtype=np.int64) # -2 pads, not a token nor the root
+    gold = np.full((B, L), -2, dtype=np.int64)
+    top = np.array([len(stack) - 1 for stack, _ in configs])
+    constrained = np.arange(L) < top[:, None] # the tokens of the stack below its top
+    for b, ((stack, _), head, x) in enumerate(zip(configs, heads, nodes)):
+        N[b, :len(x)] = x
+        gold[b, :len(x)] = [head[k] for k in x]
+    W = (gold[:, None, :] != N[:, :, None]).astype(np.float32) # W[b, i, j]: loss of the arc N[i] -> N[j]
+    W_root = (gold != -1).astype(np.float32)
+
+    # complete (CL: head on the left, CR: head on the right) and incomplete (IL: arc s -> t, IR: arc t -> s) spans,
+    # IR_reach: IR where the right span of s is not empty
+    CL, CR, IL, IR, IR_reach = [np.full((B, L, L), np.inf, dtype=np.float32) for _ in range(5)]
+    diag = np.arange(L)
+    CL[:, diag, diag] = 0.
+    CR[:, diag, diag] = 0.
+    for w in range(1, L):
+        s = np.arange(L - w)
+        t = s + w
+        r = s[:, None] + np.arange(w) # the splits s <= r < t
+        X = CL[:, s[:, None], r] + CR[:, r + 1, t[:, None]]
+        IL[:, s, t] = X.min(-1) + W[:, s, t]
+        IR[:, s, t] = X.min(-1) + W[:, t, s]
+        if w > 1:
+            IR_reach[:, s, t] = X[:, :, 1:].min(-1) + W[:, t, s]
+        # the right span of a constrained token is empty or reaches the top of the stack,
+        # and it is not empty if the token has a head on its left
+        Y = IL[:, s[:, None], r + 1] + CL[:, r + 1, t[:, None]]
+        Y[:, :, -1] = np.where(constrained[:, t], np.inf, Y[:, :, -1])
+        CL[:, s, t] = np.where(constrained[:, s] & (t < top[:, None]), np.inf, Y.min(-1))
+        # or if it has a child on its left
+        IR_left = np.where(constrained[:, r] & (r > s[:, None]), IR_reach[:, r, t[:, None]], IR[:, r, t[:, None]])
+        CR[:, s, t] = (CR[:, s[:, None], r] + IR_left).min(-1)
+
+    # the root j heads the complete spans 0..j and j..n-1
+    root = CR[:, 0, :] + CL[np.arange(B), :, lengths - 1] + W_root
+    root[np.arange(L) >= lengths[:, None]] = np.inf
+    return root.min(-1)
+
+def optimal_transitions(configs, heads):
+    """ The transitions (Left-Arc, Right-Arc, Shift) of each configuration that keep the least loss.
+    @param configs (list): (stack, next) of each configuration, which is not finished
+    @param heads (list): the gold heads of the sentence of each configuration
+    @return optimal (np.array): (len(configs), 3), whether each transition is optimal
+    """
+    successors, index, arc_loss = [], [], []
+    for i, ((stack, next_), head) in enumerate(zip(configs, heads)):
+        if len(stack) >= 2:
+            successors += [(stack[:-2] + stack[-1:], next_), (stack[:-1], next_)]
+            index += [(i, 0), (i, 1)]
+            arc_loss += [head[stack[-2]] != stack[-1], head[stack[-1]] != stack[-2]]
+        if next_ < len(head):
+            successors.append((stack + (next_,), next_ + 1))
+            index.append((i, 2))
+            arc_loss.append(False)
+    i, t = np.array(index).T
+    loss = np.full((len(configs), 3), np.inf, dtype=np.float32)
+    loss[i, t] = min_loss(successors, [heads[k] for k in i]) + np.array(arc_loss)
+    return loss == loss.min(-1, keepdims=True)
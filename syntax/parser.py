@@ -12,14 +12,20 @@ from torch.distributions.categorical import Categorical
 import numpy as np
 import math
 import random
+import heapq
+import itertools
 
 NULL = '<NULL>'
 try:
     from utils import SYMBOLS
-    from .general_utils import minibatches
+    from .oracle import optimal_transitions
+    import dist_utils
     TOKENS = SYMBOLS + [NULL]
 except ImportError:
-    from general_utils import minibatches
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # dist_utils is in the parent dir
+    from oracle import optimal_transitions
+    import dist_utils
     TOKENS = list('0123456789+-*/!') + [NULL]
 
 TRANSITIONS = ['L', 'R', 'S'] # Left-Arc, Right-Arc, Shift 
@@ -68,8 +74,18 @@ class ParserModel(nn.Module):
 
 class Parser(object):
     """Contains everything needed for transition-based dependency parsing except for the model"""
-    def __init__(self):
-
+    def __init__(self, decode='greedy', max_exact_len=15, beam_size=8, explore=0.9):
+        """
+        @param decode (str): 'greedy', or 'dp' to decode the most probable transitions by dynamic programming
+                             in eval mode (see parse_dp), the transitions are always sampled in training
+        @param max_exact_len (int): longer sentences are decoded by beam search in the 'dp' mode
+        @param beam_size (int): beam size of the beam search
+        @param explore (float): probability of following the model rather than the oracle in learning
+        """
+        self.decode = decode
+        self.max_exact_len = max_exact_len
+        self.beam_size = beam_size
+        self.explore = explore
         self.n_trans = len(TRANSITIONS)
         self.n_features = 18
         self.n_tokens = len(TOKENS)
@@ -79,6 +95,7 @@ class Parser(object):
         self.device = torch.device('cpu')
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=1e-4, amsgrad=True)
         self.criterion = nn.CrossEntropyLoss(ignore_index=-1)
+        self.version = 0 # increased whenever the model changes
     
     def train(self):
         self.model.train()
@@ -100,8 +117,10 @@ class Parser(object):
         self.model.load_state_dict(loaded['model'])
         if 'optimizer' in loaded:
             self.optimizer.load_state_dict(loaded['optimizer'])
+        self.version += 1
 
     def extend(self, n):
+        self.version += 1
         self.model.extend(n)
         TOKENS = SYMBOLS + [NULL]
         self.n_tokens = len(TOKENS)
@@ -211,40 +230,149 @@ class Parser(object):
         labels += [1] if len(buf) > 0 else [0] # shift
         return labels
 
-    def parse(self, sentences, batch_size=5000):
+    def parse(self, sentences, batch_size=5000, compact_ratio=0.5):
+        if self.decode == 'dp' and not self.model.training:
+            return self.parse_dp(sentences, self.max_exact_len, self.beam_size)
         parses = []
-        partial_parses = [PartialParse(sen) for sen in sentences]
-        unfinished_parses = partial_parses[:]
-        while unfinished_parses:
-            minibatch_parses = unfinished_parses[:batch_size]
-            unfinished_parses = unfinished_parses[batch_size:]
-            parse_index = list(range(len(minibatch_parses)))
-            batch_parses = [None] * len(minibatch_parses)
-            while minibatch_parses:
-                transitions, probs = self.predict(minibatch_parses)
-                probs = probs.detach().cpu().numpy()
-                transitions = transitions.detach().cpu().numpy()
-                index_rm = []
-                for i in range(len(minibatch_parses)):
-                    minibatch_parses[i].parse_step(transitions[i], probs[i])
-                    if minibatch_parses[i].finish:
-                        batch_parses[parse_index[i]] = minibatch_parses[i]
-                        index_rm.append(i)
-                for index in sorted(index_rm, reverse=True):   #we need to use 'del' in reverse order 
-                    del minibatch_parses[index]
-                    del parse_index[index]
-            parses.extend(batch_parses)
+        for i in range(0, len(sentences), batch_size):
+            parses.extend(self.parse_batch(sentences[i:i+batch_size], compact_ratio))
         return parses
 
-    def predict(self, partial_parses):
-        mb_x = [self.extract_features(p.stack, p.buffer, p.dependencies, p.sentence) for p in partial_parses]
-        mb_x = np.array(mb_x).astype('int32')
-        mb_x = torch.from_numpy(mb_x).long().to(self.device)
-        mb_l = [self.legal_labels(p.stack, p.buffer) for p in partial_parses]
+    def parse_batch(self, sentences, compact_ratio=0.5):
+        """ Parse a batch of sentences, with the states of all the parses stored in tensors on self.device (BatchParse).
+            Every step extracts the features, predicts and applies the transitions of the whole batch at once.
+            Finished parses stay in the batch (their transitions are ignored) until fewer than compact_ratio
+            of the rows are active, then the batch is compacted to the active rows.
+        """
+        batch = BatchParse(sentences, self.tok2id[NULL], self.device)
+        rows = torch.arange(len(sentences), device=self.device)
+        with torch.no_grad(): # the parses are only read, the parser learns from the instances of learn
+            while len(rows) > 0:
+                preds, probs = self.predict(batch.features(rows), batch.legal(rows))
+                batch.step(rows, preds, probs)
+                active = ~batch.finish[rows]
+                if active.sum() < compact_ratio * len(rows):
+                    rows = rows[active]
+        return batch.parses()
+
+    def parse_dp(self, sentences, max_exact_len=15, beam_size=8, max_states=2000, batch_size=20000):
+        """ Decode the most probable transition sequence of each sentence.
+            A sentence of at most max_exact_len tokens is decoded exactly by a best-first search over the states
+            (stack, buffer and arcs), with the cost -log p of the transitions so far. The derivations that reach
+            the same state are merged, only the cheapest one is expanded. Every round pops up to beam_size states
+            of each sentence and expands those of all the sentences together by batched calls of the model.
+            A round stops popping at the first finished state: it is the most probable derivation if it is the
+            cheapest state of the queue, i.e. popped first, otherwise it is pushed back until the cheaper states
+            popped before it are expanded. The longer sentences, and those needing more than max_states
+            expansions, are decoded by beam search.
+        """
+        parses = [None] * len(sentences)
+        n_steps = [2 * len(s) - 1 for s in sentences]
+        counter = itertools.count() # breaks the ties of the queues
+        queues = {i: [(0., next(counter), ((), 0, (-1,) * len(s)), (), ())]
+                  for i, s in enumerate(sentences) if len(s) <= max_exact_len}
+        closed = {i: set() for i in queues}
+        while queues:
+            states = []
+            for i in list(queues):
+                queue, popped = queues[i], []
+                while queue and len(popped) < beam_size:
+                    item = heapq.heappop(queue)
+                    cost, _, key, trans, arcs = item
+                    if key in closed[i]:
+                        continue
+                    if len(trans) == n_steps[i]:
+                        if popped: # the successors of the cheaper popped states may still beat it
+                            heapq.heappush(queue, item)
+                        else:
+                            parses[i] = self.finish_parse(sentences[i], key, trans, arcs)
+                        break
+                    closed[i].add(key)
+                    popped.append((i, cost, key, trans, arcs))
+                if parses[i] is not None or not queue and not popped or len(closed[i]) > max_states:
+                    del queues[i]
+                else:
+                    states.extend(popped)
+            probs = self.transition_probs(sentences, [(i, key) for i, _, key, _, _ in states], batch_size)
+            for (i, cost, key, trans, arcs), p in zip(states, probs):
+                for t, new_key, arc in self.successors(key, p):
+                    if new_key not in closed[i]:
+                        heapq.heappush(queues[i], (cost - math.log(p[t]), next(counter), new_key, trans + (t,), arcs + arc))
+
+        rest = [i for i, pt in enumerate(parses) if pt is None]
+        for i, pt in zip(rest, self.parse_beam([sentences[i] for i in rest], beam_size, batch_size)):
+            parses[i] = pt
+        return parses
 
-        logits = self.model(mb_x)
+    def parse_beam(self, sentences, beam_size=8, batch_size=20000):
+        """ Beam search: the states reachable in t steps are expanded together, and the beam_size most probable
+            ones of each sentence are kept. All the derivations have 2n-1 steps, so the finished states are compared
+            in the same step. The derivations that reach the same state are merged.
+        """
+        # a beam maps the states (stack, next, head) to (log prob, transitions, arcs), with arcs as (dependent, prob)
+        beams = [{((), 0, (-1,) * len(s)): (0., (), ())} for s in sentences]
+        parses = [None] * len(sentences)
+        n_steps = [2 * len(s) - 1 for s in sentences]
+        for step in range(max(n_steps, default=0)):
+            states = [(i, key, value) for i, beam in enumerate(beams) if step < n_steps[i] for key, value in beam.items()]
+            probs = self.transition_probs(sentences, [(i, key) for i, key, _ in states], batch_size)
+            new_beams = [{} for _ in sentences]
+            for (i, key, (logp, trans, arcs)), p in zip(states, probs):
+                for t, new_key, arc in self.successors(key, p):
+                    value = (logp + math.log(p[t]), trans + (t,), arcs + arc)
+                    if new_key not in new_beams[i] or new_beams[i][new_key][0] < value[0]:
+                        new_beams[i][new_key] = value
+            for i, beam in enumerate(new_beams):
+                if step >= n_steps[i]:
+                    continue
+                beams[i] = dict(sorted(beam.items(), key=lambda x: -x[1][0])[:beam_size])
+                if step == n_steps[i] - 1:
+                    key, (_, trans, arcs) = max(beams[i].items(), key=lambda x: x[1][0])
+                    parses[i] = self.finish_parse(sentences[i], key, trans, arcs)
+        return parses
+
+    def transition_probs(self, sentences, states, batch_size=20000):
+        # probabilities of the legal transitions of the states (i, (stack, next, head)) of sentences[i]
+        mb_x, mb_l = [], []
+        for i, (stack, next_, head) in states:
+            buf = range(next_, len(sentences[i]))
+            arcs = [(h, t) for t, h in enumerate(head) if h != -1]
+            mb_x.append(self.extract_features(stack, buf, arcs, sentences[i]))
+            mb_l.append(self.legal_labels(stack, buf))
+        probs = [np.zeros((0, self.n_trans))]
+        for st in range(0, len(states), batch_size):
+            x = torch.tensor(mb_x[st:st+batch_size], dtype=torch.long, device=self.device)
+            legal = torch.tensor(mb_l[st:st+batch_size], device=self.device)
+            p = nn.functional.softmax(self.model(x), dim=-1).detach() * legal
+            probs.append((p / p.sum(-1, keepdim=True)).cpu().numpy())
+        return np.concatenate(probs)
+
+    @staticmethod
+    def successors(state, p):
+        # (transition, next state, new arc) of the legal transitions from the state (stack, next, head)
+        stack, next_, head = state
+        if p[2] > 0: # Shift
+            yield 2, (stack + (next_,), next_ + 1, head), ()
+        for t in range(2):
+            if p[t] > 0:
+                h, d = (stack[-1], stack[-2]) if t == 0 else (stack[-2], stack[-1])
+                new_head = list(head)
+                new_head[d] = h
+                yield t, (stack[:-2] + (h,), next_, tuple(new_head)), ((d, float(p[t])),)
+
+    @staticmethod
+    def finish_parse(sentence, state, transitions, arcs):
+        _, _, head = state
+        return PartialParse.from_arrays(sentence, np.array(head), np.array(transitions),
+                                        np.array([d for d, _ in arcs], dtype=np.int64), np.array([p for _, p in arcs]))
+
+    def predict(self, x, legal):
+        """ Predict the transitions from the features x (batch_size, n_features) and the mask of legal transitions.
+            The transitions are sampled in training, and the most probable legal ones are taken otherwise.
+        """
+        logits = self.model(x)
         probs = nn.functional.softmax(logits, dim=-1)
-        probs *= torch.tensor(mb_l, dtype=probs.dtype, device=probs.device)
+        probs *= legal.to(probs.dtype)
         probs /= probs.sum(-1, keepdim=True)
 
         if self.model.training:
@@ -262,7 +390,7 @@ class Parser(object):
         UAS = all_tokens = 0.0
         with tqdm(total=len(dataset)) as prog:
             for i, ex in enumerate(dataset):
-                head = parses[i].dependencies
+                head = parses[i].head
                 for pred_h, gold_h in zip(head, ex['head']):
                     UAS += 1 if pred_h == gold_h else 0
                     all_tokens += 1
@@ -270,21 +398,65 @@ class Parser(object):
         UAS /= all_tokens
         return UAS
 
-    def learn(self, dataset, n_iters=100):
-        train_data = self.create_instances([{'word': x.sentence, 'head': x.head} for x in dataset])
+    def dynamic_instances(self, dataset, batch_size=1024, explore=0.9, chunk_size=2048):
+        """ Training instances given by the dynamic oracle (see oracle.py), streamed as minibatches (x, y).
+            The sentences of a chunk are parsed together by the model. At every step, the target is the optimal
+            transition preferred by the model, and the parse follows the transition sampled from the model with
+            probability explore, or the target otherwise. So the instances also cover the states off the gold
+            path that the model runs into. The instances of a chunk are shuffled, and those left over after the
+            full minibatches are carried to the next chunk.
+        """
+        xs, ys = [], []
+        for st in range(0, len(dataset), chunk_size):
+            chunk = dataset[st:st+chunk_size]
+            batch = BatchParse([x.sentence for x in chunk], self.tok2id[NULL], self.device)
+            rows = torch.arange(len(chunk), device=self.device)
+            while True:
+                rows = rows[~batch.finish[rows]]
+                if len(rows) == 0:
+                    break
+                x, legal = batch.features(rows), batch.legal(rows)
+                with torch.no_grad():
+                    preds, probs = self.predict(x, legal)
+                optimal = optimal_transitions(batch.configs(rows), [chunk[i].head for i in rows.tolist()])
+                optimal = torch.from_numpy(optimal).to(self.device)
+                target = probs.masked_fill(~optimal, -1.).argmax(-1)
+                explored = torch.rand(len(rows), device=self.device) < explore
+                batch.step(rows, torch.where(explored, preds, target))
+                xs.append(x)
+                ys.append(target)
+
+            x, y = torch.cat(xs), torch.cat(ys)
+            perm = torch.randperm(len(x), device=self.device)
+            x, y = x[perm], y[perm]
+            n = len(x) - len(x) % batch_size
+            for i in range(0, n, batch_size):
+                yield x[i:i+batch_size], y[i:i+batch_size]
+            xs, ys = [x[n:]], [y[n:]]
+        if len(xs) > 0 and len(xs[0]) > 0:
+            yield xs[0], ys[0]
 
+    def learn(self, dataset, n_iters=100):
+        self.version += 1
         batch_size = 1024
-        n_epochs = int(math.ceil(batch_size * n_iters / len(train_data)))
-        n_epochs = max(n_epochs, 5) # run at least 5 epochs
+        # every parse gives 2n-1 instances, along the gold path in the first epoch, and also off it in the next ones
+        n_instances = sum([2 * len(x.sentence) - 1 for x in dataset])
+        n_epochs = int(math.ceil(batch_size * n_iters / n_instances))
+        n_epochs = max(n_epochs, 2) # run at least one epoch with exploration
         print(n_epochs, "epochs, ", end='')
+        dataset = dist_utils.shard(list(dataset)) # each rank learns from its own part, the gradients are averaged
+        n_batches = None
+        if dist_utils.is_distributed(): # the same number of iterations on every rank, at least one
+            # the rank with the fewest instances yields them all, its last minibatch being partial
+            n_local = sum([2 * len(x.sentence) - 1 for x in dataset])
+            n_batches = int(math.ceil(min(dist_utils.all_gather_object(n_local)) / batch_size))
         self.model.train() # Places model in "train" mode, i.e. apply dropout layer
+        model = dist_utils.data_parallel(self.model)
         for epoch in range(n_epochs):
-            for i, (train_x, train_y) in enumerate(minibatches(train_data, batch_size)):
-                train_x = torch.from_numpy(train_x).long()
-                train_y = torch.from_numpy(train_y.nonzero()[1]).long()
-                train_x = train_x.to(self.device)
-                train_y = train_y.to(self.device)
-                output_y = self.model(train_x)
+            random.shuffle(dataset)
+            instances = self.dynamic_instances(dataset, batch_size, explore=0. if epoch == 0 else self.explore)
+            for train_x, train_y in itertools.islice(instances, n_batches):
+                output_y = model(train_x)
                 loss = self.criterion(output_y, train_y)
 
                 self.optimizer.zero_grad()   # remove any baggage in the optimizer
@@ -292,57 +464,186 @@ class Parser(object):
                 self.optimizer.step()
 
 class PartialParse(object):
-    def __init__(self, sentence):
+    """ The state of an arc-standard parse of a sentence of n tokens.
+        The buffer is sentence[next:], and the transitions (2n-1 in total) and the probabilities of the
+        arcs (n-1 in total) are written into arrays allocated up front. The full probability vector
+        of each step is only kept with record_probs=True.
+    """
+    __slots__ = ['sentence', 'stack', 'next', 'head', 'transitions', 'n_steps',
+                 'arc_tails', 'arc_probs', 'n_arcs', 'probs', 'finish']
+
+    def __init__(self, sentence, record_probs=False):
         """Initializes this partial parse.
         @param sentence (list of str): The sentence to be parsed as a list of words.
                                         Your code should not modify the sentence.
+        @param record_probs (bool): whether to keep the probability vector of every step in self.probs
         """
+        n = len(sentence)
         self.sentence = sentence
-        self.stack = [] 
-        self.buffer = list(range(len(sentence)))
-        self.dependencies = []
-        self.transitions = []
-        self.probs = []
+        self.stack = []
+        self.next = 0 # index of the front of the buffer
+        self.head = [-1] * n
+        self.transitions = np.zeros(max(2 * n - 1, 0), dtype=np.int8)
+        self.n_steps = 0
+        self.arc_tails = np.zeros(max(n - 1, 0), dtype=np.int16)
+        self.arc_probs = np.zeros(max(n - 1, 0), dtype=np.float32)
+        self.n_arcs = 0
+        self.probs = [] if record_probs else None
         self.finish = False # whether the parse has finished
 
+    @staticmethod
+    def from_arrays(sentence, head, transitions, arc_tails, arc_probs):
+        # a finished parse from the arrays of Parser.parse_batch
+        pt = PartialParse(sentence)
+        n = len(sentence)
+        pt.stack = [int(np.nonzero(head == -1)[0][0])]
+        pt.next = n
+        pt.head = head.tolist()
+        pt.transitions[:] = transitions
+        pt.n_steps = 2 * n - 1
+        pt.arc_tails[:] = arc_tails
+        pt.arc_probs[:] = arc_probs
+        pt.n_arcs = n - 1
+        pt.finish = True
+        return pt
+
+    @property
+    def buffer(self):
+        return range(self.next, len(self.sentence))
+
+    @property
+    def dependencies(self):
+        # arcs (head, dependent, prob) in the order they were added
+        return [(self.head[t], t, p) for t, p in zip(self.arc_tails[:self.n_arcs].tolist(),
+                                                    self.arc_probs[:self.n_arcs].tolist())]
+
     def parse_step(self, transition, prob=None):
         """Performs a single parse step by applying the given transition to this partial parse
-        @param transition (str): A string that equals "S", "LA", or "RA" representing the shift,
-                                left-arc, and right-arc transitions. You can assume the provided
-                                transition is a legal transition.
+        @param transition (int): 0, 1 or 2 for the left-arc, right-arc and shift transitions.
+                                You can assume the provided transition is a legal transition.
+        @param prob (array): probabilities of the transitions, None if the transition is given
         """
-        transition_prob = prob[transition]
-        if transition == 0: # Left-Arc
-            d=(self.stack[-1],self.stack[-2],transition_prob)
-            self.dependencies.append(d)
-            self.stack.pop(-2)
-        elif transition == 1: # Right-Arc
-            d=(self.stack[-2],self.stack[-1],transition_prob)
-            self.dependencies.append(d)
-            self.stack.pop(-1)
-        elif transition == 2: # Shift
-            self.stack.append(self.buffer.pop(0))
-        self.transitions.append(transition)
-        self.probs.append(prob)
-        if len(self.buffer) == 0 and len(self.stack) == 1:
-            self.finish = True
-            self.compute_head()
-    
-    def compute_head(self):
-        self.head = [-1] * len(self.sentence)
-        for arc in self.dependencies:
-            h, t = arc[:2]
+        stack = self.stack
+        if transition == 2: # Shift
+            stack.append(self.next)
+            self.next += 1
+        else:
+            if transition == 0: # Left-Arc
+                h, t = stack[-1], stack.pop(-2)
+            else: # Right-Arc
+                t = stack.pop(-1)
+                h = stack[-1]
             self.head[t] = h
+            self.arc_tails[self.n_arcs] = t
+            self.arc_probs[self.n_arcs] = 1. if prob is None else prob[transition]
+            self.n_arcs += 1
+        self.transitions[self.n_steps] = transition
+        self.n_steps += 1
+        if self.probs is not None:
+            self.probs.append(prob)
+        if self.next == len(self.sentence) and len(stack) == 1:
+            self.finish = True
 
     def parse(self, transitions):
         """Applies the provided transitions to this PartialParse
 
-        @param transitions (list of str): The list of transitions in the order they should be applied
+        @param transitions (list of int): The list of transitions in the order they should be applied
 
-        @return dsependencies (list of string tuples): The list of dependencies produced when
-                                                        parsing the sentence. Represented as a list of
-                                                        tuples where each tuple is of the form (head, dependent).
+        @return dependencies (list of tuples): The list of dependencies produced when parsing the sentence.
+                                               Represented as a list of tuples of the form (head, dependent, prob).
         """
         for transition in transitions:
             self.parse_step(transition)
         return self.dependencies
+
+class BatchParse(object):
+    """ The states of a batch of arc-standard parses, stored in tensors: the stack, the front of the buffer, the heads,
+        the two leftmost and the two rightmost children of each token (so the features are gathered in O(1)),
+        the transitions and the probabilities of the arcs. A step applies the transitions of the given rows at once.
+    """
+    def __init__(self, sentences, null, device):
+        self.sentences = sentences
+        self.device = device
+        B = len(sentences)
+        self.lengths = np.array([len(s) for s in sentences])
+        L = self.L = int(self.lengths.max())
+        # index L is "no token": its token is NULL and it has no children
+        tokens = np.full((B, L + 1), null, dtype=np.int64)
+        tokens[:, :L][np.arange(L) < self.lengths[:, None]] = np.concatenate([np.asarray(s) for s in sentences])
+        self.tokens = torch.from_numpy(tokens).to(device)
+        self.n = torch.from_numpy(self.lengths).to(device)
+
+        full = lambda size, value: torch.full(size, value, dtype=torch.long, device=device)
+        self.stack = full((B, L + 3), L) # the stack is stack[:, 3:3+sp], the first 3 columns pad the top-3 features
+        self.sp = full((B,), 0)
+        self.next = full((B,), 0) # the buffer is [next, n)
+        self.lc1, self.lc2, self.rc1, self.rc2 = [full((B, L + 1), L) for _ in range(4)]
+        self.head = full((B, L), -1)
+        self.transitions = full((B, max(2 * L - 1, 1)), -1)
+        self.arc_tails = full((B, max(L - 1, 1)), -1)
+        self.arc_probs = torch.zeros((B, max(L - 1, 1)), device=device)
+        self.n_arcs = full((B,), 0)
+        self.finish = torch.zeros(B, dtype=torch.bool, device=device)
+        self.n_steps = 0
+        self.offsets = torch.arange(3, device=device)
+
+    def features(self, rows):
+        # the same 18 features as Parser.extract_features
+        r = rows[:, None]
+        s = self.stack[r, self.sp[r] + self.offsets] # s2, s1, s0
+        b = self.next[r] + self.offsets
+        b = torch.where(b < self.n[r], b, torch.full_like(b, self.L))
+        k = s[:, [2, 1]] # s0, s1
+        lc, rc = self.lc1[r, k], self.rc1[r, k]
+        children = torch.stack([lc, rc, self.lc2[r, k], self.rc2[r, k], self.lc1[r, lc], self.rc1[r, rc]], -1)
+        return self.tokens[r, torch.cat([s, b, children.view(len(rows), -1)], 1)]
+
+    def legal(self, rows):
+        # the finished parses may shift, so that their probabilities are defined, but their transitions are ignored
+        sp = self.sp[rows]
+        return torch.stack([sp >= 2, sp >= 2, (self.next[rows] < self.n[rows]) | self.finish[rows]], 1)
+
+    def configs(self, rows):
+        # (stack, next) of the rows
+        stack, sp, next_ = self.stack[rows, 3:].tolist(), self.sp[rows].tolist(), self.next[rows].tolist()
+        return [(tuple(s[:k]), n) for s, k, n in zip(stack, sp, next_)]
+
+    def step(self, rows, transitions, probs=None):
+        active = ~self.finish[rows]
+        self.transitions[rows[active], self.n_steps] = transitions[active]
+        if probs is not None:
+            arc_prob = probs.gather(1, transitions[:, None]).squeeze(1)
+        stack, sp = self.stack, self.sp
+        for t in range(3):
+            sel = active & (transitions == t)
+            a = rows[sel]
+            if len(a) == 0:
+                continue
+            top = sp[a] + 2
+            if t == 2: # Shift
+                stack[a, top + 1] = self.next[a]
+                sp[a] += 1
+                self.next[a] += 1
+                continue
+            if t == 0: # Left-Arc
+                h, d = stack[a, top], stack[a, top - 1]
+                self.lc2[a, h] = self.lc1[a, h]
+                self.lc1[a, h] = d
+                stack[a, top - 1] = h
+            else: # Right-Arc
+                h, d = stack[a, top - 1], stack[a, top]
+                self.rc2[a, h] = self.rc1[a, h]
+                self.rc1[a, h] = d
+            self.head[a, d] = h
+            self.arc_tails[a, self.n_arcs[a]] = d
+            self.arc_probs[a, self.n_arcs[a]] = 1. if probs is None else arc_prob[sel]
+            self.n_arcs[a] += 1
+            sp[a] -= 1
+        self.finish[rows] = (self.next[rows] == self.n[rows]) & (sp[rows] == 1)
+        self.n_steps += 1
+
+    def parses(self):
+        head, transitions = self.head.cpu().numpy(), self.transitions.cpu().numpy()
+        arc_tails, arc_probs = self.arc_tails.cpu().numpy(), self.arc_probs.detach().cpu().numpy()
+        return [PartialParse.from_arrays(s, head[i, :l], transitions[i, :2*l-1], arc_tails[i, :l-1], arc_probs[i, :l-1])
+                for i, (s, l) in enumerate(zip(self.sentences, self.lengths))]
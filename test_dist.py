@@ -0,0 +1,57 @@
+"""
+Data-parallel learning of the parser with a buffer smaller than a minibatch, on 2 local gloo ranks.
+    python test_dist.py
+Every rank has to run the same number of steps, at least one, and keep the same weights.
+"""
+import socket
+from collections import namedtuple
+
+import torch
+import torch.multiprocessing as mp
+
+import dist_utils
+from syntax import Parser
+
+Parse = namedtuple('Parse', ['sentence', 'head'])
+WORLD_SIZE = 2
+
+def small_buffer():
+    # 1 + 2, 3 * 4 - 5 and 6: far fewer than 1024 instances
+    return [Parse([1, 10, 2], [1, -1, 1]), Parse([3, 12, 4, 11, 5], [1, 3, 1, -1, 3]), Parse([6], [-1])]
+
+def run(rank, port, results):
+    import os
+    os.environ['MASTER_PORT'] = str(port)
+    dist_utils.init(rank, WORLD_SIZE)
+    torch.manual_seed(rank)
+    parser = Parser()
+    dist_utils.broadcast_module(parser.model)
+    before = [p.detach().clone() for p in parser.model.parameters()]
+    n_steps = [0]
+    step = parser.optimizer.step
+    def counted_step(*args, **kwargs):
+        n_steps[0] += 1
+        return step(*args, **kwargs)
+    parser.optimizer.step = counted_step
+    parser.learn(small_buffer(), n_iters=1)
+    changed = any((p != q).any().item() for p, q in zip(before, parser.model.parameters()))
+    weights = torch.cat([p.detach().flatten() for p in parser.model.parameters()])
+    results[rank] = (n_steps[0], changed, weights)
+    dist_utils.cleanup()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def test_learn_small_buffer():
+    results = mp.Manager().dict()
+    mp.spawn(run, args=(free_port(), results), nprocs=WORLD_SIZE)
+    n_steps = [results[r][0] for r in range(WORLD_SIZE)]
+    assert n_steps[0] > 0 and len(set(n_steps)) == 1, n_steps
+    assert all(results[r][1] for r in range(WORLD_SIZE))
+    assert torch.equal(results[0][2], results[1][2])
+
+if __name__ == "__main__":
+    test_learn_small_buffer()
+    print('ok')
@@ -1,16 +1,12 @@
-from utils import DEVICE, SYMBOLS, ID2SYM, SYM2ID
+from utils import DEVICE, SYMBOLS, ID2SYM, SYM2ID, SYMBOL_TABLE
 import time
 from tqdm import tqdm
 from collections import Counter
 
-from sklearn.metrics import classification_report, confusion_matrix
-import pandas as pd
-pd.set_option('display.max_rows', 500)
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1000)
-
 from dataset import HINT, HINT_collate
 from jointer import Jointer
+from buffer import SampleBuffer
+import dist_utils
 
 import torch
 import numpy as np
@@ -19,6 +15,7 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 import argparse
 import sys
+import os
 
 def parse_args():
     parser = argparse.ArgumentParser('Give Me A HINT')
@@ -33,15 +30,26 @@ def parse_args():
     parser.add_argument('--perception', action="store_true", help='whether to provide perfect perception, i.e., no need to learn')
     parser.add_argument('--syntax', action="store_true", help='whether to provide perfect syntax, i.e., no need to learn')
     parser.add_argument('--semantics', action="store_true", help='whether to provide perfect semantics, i.e., no need to learn')
+    parser.add_argument('--bf16', action="store_true", help='run the perception in bfloat16 autocast on CPU')
+    parser.add_argument('--parser-decode', type=str, default='greedy', choices=['greedy', 'dp'],
+                        help='decoding of the parser in eval mode: greedy, or exact search (beam search for long sentences)')
+    parser.add_argument('--enumeration-scheduler', action="store_true",
+                        help='enumerate the semantics of each symbol in its own process with a difficulty-based CPU budget, '
+                        'instead of explorationCompression with the recognition model')
+    parser.add_argument('--perception-budget', type=int, default=100,
+                        help='max number of two-symbol substitutions tried per sample by the perception abduction, '
+                        'after all the one-symbol ones')
     parser.add_argument('--curriculum', action="store_true", help='whether to use the pre-defined curriculum')
 
     parser.add_argument('--epochs', type=int, default=100, help='number of epochs for training')
     parser.add_argument('--epochs_eval', type=int, default=10, help='how many epochs per evaluation')
+    parser.add_argument('--world-size', type=int, default=1, help='number of local processes for distributed training (gloo). '
+                        'For multiple nodes, launch with torch.distributed.launch, which sets RANK and WORLD_SIZE.')
     args = parser.parse_args()
     return args
 
-from nltk.tree import Tree
 def draw_parse(sentence, head):
+    from nltk.tree import Tree
     def build_tree(pos):
         children = [i for i, h in enumerate(head) if h == pos]
         return Tree(sentence[pos], [build_tree(x) for x in children])
@@ -51,6 +59,12 @@ def draw_parse(sentence, head):
     return tree
 
 def evaluate(model, dataloader, n_steps=1):
+    # the reporting dependencies are only imported when evaluating
+    from sklearn.metrics import classification_report, confusion_matrix
+    import pandas as pd
+    pd.set_option('display.max_rows', 500)
+    pd.set_option('display.max_columns', 500)
+    pd.set_option('display.width', 1000)
     model.eval() 
     res_all = []
     res_pred_all = []
@@ -65,7 +79,8 @@ def evaluate(model, dataloader, n_steps=1):
         for sample in tqdm(dataloader):
             res = sample['res']
             expr = sample['expr']
-            dep = sample['head']
+            mask = torch.arange(sample['head'].shape[1]) < sample['len'][:, None]
+            dep = sample['head'][mask].numpy()
 
             res_preds, expr_preds, dep_preds = model.deduce(sample, n_steps=n_steps)
             
@@ -74,7 +89,7 @@ def evaluate(model, dataloader, n_steps=1):
             expr_pred_all.extend(expr_preds)
             expr_all.extend(expr)
             dep_pred_all.extend(dep_preds)
-            dep_all.extend(dep)
+            dep_all.append(dep)
 
     res_pred_all = np.concatenate(res_pred_all, axis=0)
     res_all = np.concatenate(res_all, axis=0)
@@ -83,10 +98,10 @@ def evaluate(model, dataloader, n_steps=1):
     
 
     pred = [y for x in expr_pred_all for y in x]
-    gt = [SYM2ID(y) for x in expr_all for y in x]
+    gt = SYMBOL_TABLE.encode(''.join(expr_all))
     assert len(gt) == len(pred)
-    mask = np.array([0 if x == SYM2ID('(') or x == SYM2ID(')')  else 1 for x in gt], dtype=bool)
-    perception_acc = np.mean([x == y for x,y in zip(pred, gt)])
+    mask = (gt != SYM2ID('(')) & (gt != SYM2ID(')'))
+    perception_acc = np.mean(np.array(pred) == gt)
 
     report = classification_report(gt, pred, target_names=SYMBOLS)
     cmtx = confusion_matrix(gt, pred, normalize='all')
@@ -98,9 +113,10 @@ def evaluate(model, dataloader, n_steps=1):
     print(report)
     print(cmtx)
 
-    pred = [y for x in dep_pred_all for y in x]
-    gt = [y for x in dep_all for y in x]
-    head_acc = np.mean(np.array(pred)[mask] == np.array(gt)[mask])
+    pred = np.concatenate(dep_pred_all)
+    gt = np.concatenate(dep_all)
+    head_acc = np.mean(pred[mask] == gt[mask])
+    dep_all = np.split(gt, np.cumsum([len(x) for x in expr_all])[:-1])
 
     print("result accuracy by length:")
     for k in sorted(dataloader.dataset.len2ids.keys()):
@@ -156,13 +172,23 @@ def evaluate(model, dataloader, n_steps=1):
 
     return perception_acc, head_acc, result_acc
 
+def make_train_loader(train_set, batch_size, shuffle=False, seed=0):
+    # in distributed training, each rank deduces and abduces its own shard of the training set.
+    # The workers are persistent, the curriculum filters the training set in place. The order is drawn by
+    # the sampler from the seed and its epoch (set_epoch), also with a single process.
+    sampler = dist_utils.DistributedSampler(train_set, num_replicas=dist_utils.get_world_size(),
+                                            rank=dist_utils.get_rank(), shuffle=shuffle, seed=seed)
+    return torch.utils.data.DataLoader(train_set, batch_size=batch_size, sampler=sampler,
+                         num_workers=4, collate_fn=HINT_collate, persistent_workers=True)
+
 def train(model, args, st_epoch=0):
     best_acc = 0.0
     batch_size = 32
-    train_dataloader = torch.utils.data.DataLoader(args.train_set, batch_size=batch_size,
-                         shuffle=False, num_workers=4, collate_fn=HINT_collate)
+    train_set = args.train_set
+    is_main = dist_utils.get_rank() == 0 # only the main process evaluates and saves the model
+    train_dataloader = make_train_loader(train_set, batch_size, shuffle=args.curriculum, seed=args.seed)
     eval_dataloader = torch.utils.data.DataLoader(args.val_set, batch_size=batch_size,
-                         shuffle=False, num_workers=4, collate_fn=HINT_collate)
+                         shuffle=False, num_workers=4, collate_fn=HINT_collate, persistent_workers=True)
     
     max_len = float("inf")
     if args.curriculum:
@@ -181,22 +207,23 @@ def train(model, args, st_epoch=0):
                 max_len = l
                 break
         train_set.filter_by_len(max_len=max_len)
-        train_dataloader = torch.utils.data.DataLoader(train_set, batch_size=batch_size,
-                            shuffle=True, num_workers=4, collate_fn=HINT_collate)
     
     ###########evaluate init model###########
-    perception_acc, head_acc, result_acc = evaluate(model, eval_dataloader)
-    print('{} (Perception Acc={:.2f}, Head Acc={:.2f}, Result Acc={:.2f})'.format('val', 100*perception_acc, 100*head_acc, 100*result_acc))
+    if is_main:
+        perception_acc, head_acc, result_acc = evaluate(model, eval_dataloader)
+        print('{} (Perception Acc={:.2f}, Head Acc={:.2f}, Result Acc={:.2f})'.format('val', 100*perception_acc, 100*head_acc, 100*result_acc))
     #########################################
 
     for epoch in range(st_epoch, args.epochs):
         if args.curriculum and epoch in curriculum_strategy:
             max_len = curriculum_strategy[epoch]
             train_set.filter_by_len(max_len=max_len)
-            train_dataloader = torch.utils.data.DataLoader(train_set, batch_size=batch_size,
-                                shuffle=False, num_workers=4, collate_fn=HINT_collate)
-            if len(train_dataloader) == 0:
-                continue
+        # the sampler reads the size of the filtered training set again, before its length is used.
+        # With the curriculum, the order is reshuffled every epoch, as by the shuffled loader of the baseline,
+        # and the passes of an epoch see the same batches, which the deduction cache of the model reuses
+        train_dataloader.sampler.set_epoch(epoch)
+        if args.curriculum and epoch in curriculum_strategy and len(train_dataloader) == 0:
+            continue
 
         since = time.time()
         print('-' * 30)
@@ -208,18 +235,18 @@ def train(model, args, st_epoch=0):
                 train_acc = []
                 for sample in tqdm(train_dataloader):
                     res = sample['res'].numpy()
-                    res_pred = model.deduce(sample)[0]
+                    res_pred = model.deduce(sample, use_cache=True)[0]
                     model.abduce(res, sample['img_paths'])
                     acc = np.mean(np.array(res_pred) == res)
                     train_acc.append(acc)
                 train_acc = np.mean(train_acc)
-                abduce_acc = len(model.buffer) / len(train_set)
+                abduce_acc = len(model.buffer) / len(train_dataloader.sampler)
                 print("Train acc: %.2f (abduce %.2f)"%(train_acc * 100, abduce_acc * 100))
             
             model.learn()
             model.epoch += 1
             
-        if ((epoch+1) % args.epochs_eval == 0) or (epoch+1 == args.epochs):
+        if is_main and (((epoch+1) % args.epochs_eval == 0) or (epoch+1 == args.epochs)):
             perception_acc, head_acc, result_acc = evaluate(model, eval_dataloader)
             print('{} (Perception Acc={:.2f}, Head Acc={:.2f}, Result Acc={:.2f})'.format('val', 100*perception_acc, 100*head_acc, 100*result_acc))
             if result_acc > best_acc:
@@ -232,6 +259,9 @@ def train(model, args, st_epoch=0):
         print('Epoch time: {:.0f}m {:.0f}s'.format(
             time_elapsed // 60, time_elapsed % 60))
 
+    if not is_main:
+        return
+    model.wait_saving()
     n_steps = 1
     perception_acc, head_acc, result_acc = evaluate(model, eval_dataloader, n_steps)
     print('{} (Perception Acc={:.2f}, Head Acc={:.2f}, Result Acc={:.2f})'.format('val', 100*perception_acc, 100*head_acc, 100*result_acc))
@@ -247,17 +277,25 @@ def train(model, args, st_epoch=0):
 
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    sys.argv = sys.argv[:1]
+def main(rank, args):
+    if args.world_size > 1:
+        dist_utils.init(rank, args.world_size)
+    elif int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        dist_utils.init()
+    rank = dist_utils.get_rank()
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
 
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    # different seeds for the ranks, so that they sample differently
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
 
 
     model = Jointer(args)
     model.to(DEVICE)
+    if dist_utils.is_distributed():
+        model.broadcast_parameters()
 
     if args.fewshot != -1:
         pretrained = 'bak/model_100.p'
@@ -267,15 +305,13 @@ if __name__ == "__main__":
         train_dataloader = torch.utils.data.DataLoader(train_set, batch_size=32,
                             shuffle=False, num_workers=4, collate_fn=HINT_collate)
         model.eval() 
-        model.buffer_augment = []
+        model.buffer_augment = SampleBuffer()
         with torch.no_grad():
             for sample in tqdm(train_dataloader):
                 model.deduce(sample)
-                model.buffer_augment.extend([ast for ast, y in zip(model.ASTs, sample['res']) if ast.res() == y])
                 for et, y, img_paths in zip(model.ASTs, sample['res'].numpy(), sample['img_paths']):
                     if et.res() == y:
-                        et.img_paths = img_paths
-                        model.buffer_augment.append(et)
+                        model.buffer_augment.append_ast(et, img_paths)
             print("Number of augment examples: ", len(model.buffer_augment))
 
         fewshot_concepts = list('abcde')
@@ -312,4 +348,14 @@ if __name__ == "__main__":
     args.test_set = test_set
 
     train(model, args, st_epoch=st_epoch)
+    dist_utils.cleanup()
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+
+    if args.world_size > 1:
+        torch.multiprocessing.spawn(main, args=(args,), nprocs=args.world_size)
+    else:
+        main(0, args)
 
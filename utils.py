@@ -20,13 +20,19 @@ ROOT_DIR = './data/'
 IMG_DIR = ROOT_DIR + 'symbol_images/'
 IMG_SIZE = 32
 
-from torchvision import transforms
-IMG_TRANSFORM = transforms.Compose([
+# torchvision is slow to import, the transforms are built on first use
+_img_transform = None
+def img_transform(img):
+    global _img_transform
+    if _img_transform is None:
+        from torchvision import transforms
+        _img_transform = transforms.Compose([
                     transforms.CenterCrop(IMG_SIZE),
                     transforms.ToTensor(),
                     # transforms.Lambda(lambda x: 1. - x),
                     # transforms.Normalize((0.5,), (1,))
                 ])
+    return _img_transform(img)
 
 from PIL import Image, ImageOps
 def pad_image(img, desired_size, fill=0):
@@ -34,4 +40,35 @@ def pad_image(img, desired_size, fill=0):
     delta_h = desired_size - img.size[1]
     padding = (delta_w//2, delta_h//2, delta_w-(delta_w//2), delta_h-(delta_h//2))
     new_img = ImageOps.expand(img, padding, fill)
-    return new_img
\ No newline at end of file
+    return new_img
+def load_image(img_file):
+    # img_file: a path or a file object of a symbol image
+    from torchvision import transforms
+    img = Image.open(img_file).convert('L')
+    img = ImageOps.invert(img)
+    img = pad_image(img, 60)
+    img = transforms.functional.resize(img, 40)
+    img = img_transform(img)
+    return img
+
+def add_inference_args(parser, decode=True):
+    # the arguments shared by the scripts that load a trained model (serve.py, predict.py, export.py)
+    parser.add_argument('--resume', type=str, required=True, help='checkpoint saved by Jointer.save')
+    parser.add_argument('--semantics', action="store_true", help='whether the model uses the ground-truth semantics')
+    if decode:
+        parser.add_argument('--bf16', action="store_true", help='run the perception in bfloat16 autocast on CPU')
+        parser.add_argument('--parser-decode', type=str, default='greedy', choices=['greedy', 'dp'],
+                            help='decoding of the parser in eval mode: greedy, or exact search (beam search for long sentences)')
+    return parser
+
+def load_inference_model(args, device=DEVICE):
+    # the model always predicts with its own perception and syntax
+    from jointer import Jointer # jointer imports utils
+    args.perception = False
+    args.syntax = False
+    args.fewshot = -1
+    model = Jointer(args)
+    model.load(args.resume, map_location=device)
+    model.to(device)
+    model.eval()
+    return model